@@ -409,7 +409,7 @@ def sampling_strategy(prob_distribution):
         return np.random.choice(list(range(len(prob_distribution))), p=prob_distribution)
 
 
-def calc_perplexity(sentence, model, window_size):
+def calc_perplexity(sentence, model, window_size, batch_size=32):
     tokenizer = model.tokenizer
     vocab = model.vocab
     prob = 0
@@ -417,11 +417,17 @@ def calc_perplexity(sentence, model, window_size):
     
     with torch.no_grad():
         tokens = tokenizer.encode(sentence, add_special_tokens=True)
+        positions = list(range(1, len(tokens) - 1))  # 跳过[CLS]和[SEP]
+        if not positions:
+            return 2 ** (prob * (-1 / len(tokens)))
         
-        for i in range(1, len(tokens) - 1):  # 跳过[CLS]和[SEP]
-            # 创建输入，将当前位置mask
-            input_tokens = tokens[:i] + [tokenizer.mask_token_id] + tokens[i+1:]
-            input_ids = torch.LongTensor([input_tokens])
+        # 每个位置mask一次，mask后的句子每batch_size个拼成一个batch前向
+        # 一次前向的输出是 batch×句长×词表大小，分批避免长句子显存随句长平方增长
+        for start in range(0, len(positions), batch_size):
+            batch_positions = torch.LongTensor(positions[start:start + batch_size])
+            rows = torch.arange(len(batch_positions))
+            input_ids = torch.LongTensor([tokens] * len(batch_positions))
+            input_ids[rows, batch_positions] = tokenizer.mask_token_id
             attention_mask = torch.ones_like(input_ids)
             
             if torch.cuda.is_available():
@@ -430,13 +436,13 @@ def calc_perplexity(sentence, model, window_size):
             
             # 预测
             outputs = model(input_ids, attention_mask)
-            pred_probs = outputs[0, i, :]  # 被mask位置的预测
+            pred_probs = outputs[rows, batch_positions]  # 每个句子被mask位置的预测
             
             # 计算目标token的概率
-            target_token_id = tokens[i]
-            if target_token_id < len(pred_probs):
-                target_prob = torch.softmax(pred_probs, dim=0)[target_token_id]
-                prob += math.log(target_prob.item(), 10)
+            target_token_ids = torch.LongTensor(tokens)[batch_positions]
+            target_probs = torch.softmax(pred_probs, dim=-1)[rows, target_token_ids]
+            for target_prob in target_probs.tolist():
+                prob += math.log(target_prob, 10)
     
     return 2 ** (prob * (-1 / len(tokens)))
 
@@ -0,0 +1,106 @@
+#coding:utf8
+
+import math
+import time
+import torch
+
+"""
+语言模型困惑度评估
+整个文件只做一次分词，按固定窗口+步长切分，多个窗口拼成一个batch一次前向
+每个token只在第一次作为窗口内的预测目标时计分，窗口前面重叠的部分只提供上文
+"""
+
+
+#模型按因果mask前向，返回每个位置对下一个字的logits
+#与generate_sentence中的生成方式一致
+def causal_logits(model, input_ids):
+    causal_mask = torch.tril(torch.ones((input_ids.shape[0], input_ids.shape[1], input_ids.shape[1]),
+                                        device=input_ids.device))
+    sequence_output = model.bert(input_ids=input_ids, attention_mask=causal_mask)[0]
+    return model.classify(sequence_output)  #(batch_size, seq_len, vocab_size)
+
+#逐行分词后拼接，避免对整个大文件做一次超长字符串的处理
+def encode_file(path, tokenizer, encoding="utf8"):
+    token_ids = []
+    char_count = 0
+    with open(path, encoding=encoding) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            char_count += len(line)
+            token_ids += tokenizer.encode(line, add_special_tokens=False)
+    return token_ids, char_count
+
+#切分窗口，返回(起点, 终点, 本窗口新计分的目标个数)
+#第一个字没有上文，不参与计分，所以一共计分len(token_ids) - 1个目标
+#相邻窗口至少重叠一个字，保证每个窗口第一个计分目标的上文在窗口内
+def build_windows(num_tokens, window_size, stride):
+    assert 0 < stride < window_size
+    windows = []
+    prev_end = 1
+    for begin in range(0, num_tokens - 1, stride):
+        end = min(begin + window_size, num_tokens)
+        if end <= prev_end:
+            continue
+        windows.append((begin, end, end - prev_end))
+        prev_end = end
+        if end == num_tokens:
+            break
+    return windows
+
+#一个batch的窗口一次前向，返回这些窗口中计分目标的负对数似然之和
+def score_windows(model, token_ids, windows, pad_id):
+    max_len = max(end - begin for begin, end, _ in windows)
+    input_ids = torch.full((len(windows), max_len), pad_id, dtype=torch.long)
+    labels = torch.full((len(windows), max_len), -1, dtype=torch.long)
+    for i, (begin, end, num_target) in enumerate(windows):
+        length = end - begin
+        input_ids[i, :length] = torch.LongTensor(token_ids[begin:end])
+        #位置t预测t+1，只给最后num_target个目标打分
+        labels[i, length - 1 - num_target:length - 1] = input_ids[i, length - num_target:length]
+    if torch.cuda.is_available():
+        input_ids, labels = input_ids.cuda(), labels.cuda()
+    logits = causal_logits(model, input_ids)
+    #padding在序列尾部，因果mask下不影响前面位置的结果
+    nll = torch.nn.functional.cross_entropy(logits.view(-1, logits.shape[-1]), labels.view(-1),
+                                            ignore_index=-1, reduction="sum")
+    return nll.item()
+
+def evaluate_perplexity(model, path, window_size=128, stride=64, batch_size=32, encoding="utf8"):
+    tokenizer = model.tokenizer
+    model.eval()
+    start_time = time.time()
+    token_ids, char_count = encode_file(path, tokenizer, encoding)
+    windows = build_windows(len(token_ids), window_size, stride)
+    total_nll = 0
+    num_scored = 0
+    with torch.no_grad():
+        for i in range(0, len(windows), batch_size):
+            batch_windows = windows[i:i + batch_size]
+            total_nll += score_windows(model, token_ids, batch_windows, tokenizer.pad_token_id)
+            num_scored += sum(num_target for _, _, num_target in batch_windows)
+    cost_time = time.time() - start_time
+    token_nll = total_nll / max(num_scored, 1)
+    return {
+        "tokens": num_scored,
+        "windows": len(windows),
+        "token_nll": token_nll,                                   #每个token的平均负对数似然(nats)
+        "perplexity": math.exp(token_nll),
+        "bits_per_char": total_nll / math.log(2) / max(char_count, 1),
+        "tokens_per_second": num_scored / max(cost_time, 1e-6),
+        "seconds": cost_time,
+    }
+
+
+if __name__ == "__main__":
+    import sys
+    from nnlm import build_model, build_vocab
+    vocab = build_vocab("bert-base-chinese/vocab.txt")
+    model = build_model(vocab)
+    model.load_state_dict(torch.load("model/sft_model.pth", map_location="cpu"))
+    if torch.cuda.is_available():
+        model = model.cuda()
+    result = evaluate_perplexity(model, sys.argv[1] if len(sys.argv) > 1 else "corpus.txt")
+    for key, value in result.items():
+        print("%s: %s" % (key, value))
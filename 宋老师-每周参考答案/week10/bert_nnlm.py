@@ -8,6 +8,7 @@ import random
 import os
 import re
 from transformers import BertTokenizer, BertModel
+from vocab_pruning import PrunedTokenizer, prune_model
 
 """
 基于pytorch的LSTM语言模型
@@ -122,7 +123,7 @@ def sampling_strategy(prob_distribution):
 
 
 
-def train(corpus_path, save_weight=True):
+def train(corpus_path, save_weight=True, prune_vocab=False):
     epoch_num = 20        #训练轮数
     batch_size = 128       #每次训练样本个数
     train_sample = 10000   #每轮训练总共训练的样本总数
@@ -136,7 +137,13 @@ def train(corpus_path, save_weight=True):
     tokenizer = BertTokenizer.from_pretrained(pretrain_model_path)
 
     corpus = load_corpus(corpus_path)     #加载语料
+    if prune_vocab:
+        #只保留语料中出现过的token，分段扫描避免一次编码过长的字符串
+        tokenizer = PrunedTokenizer.from_corpus(tokenizer, [corpus[i:i + 10000] for i in range(0, len(corpus), 10000)])
+        print("词表由%d裁剪为%d" % (vocab_size, tokenizer.vocab_size))
     model = build_model(vocab_size, char_dim, pretrain_model_path)    #建立模型
+    if prune_vocab:
+        prune_model(model, tokenizer.kept_ids)
     if torch.cuda.is_available():
         model = model.cuda()
     optim = torch.optim.Adam(model.parameters(), lr=learning_rate)   #建立优化器
@@ -162,6 +169,8 @@ def train(corpus_path, save_weight=True):
         base_name = os.path.basename(corpus_path).replace("txt", "pth")
         model_path = os.path.join("model", base_name)
         torch.save(model.state_dict(), model_path)
+        if prune_vocab:
+            tokenizer.save(model_path.replace(".pth", "_vocab.json"))  #加载模型时需要同样的编号映射
         return
 
 
@@ -0,0 +1,189 @@
+#coding:utf8
+
+import time
+import torch
+import torch.nn as nn
+import numpy as np
+from transformers import BertTokenizer
+from bert_nnlm import build_model, load_corpus, build_dataset
+
+"""
+投机解码(speculative decoding)
+用一个很小的LSTM语言模型(草稿模型)先连续猜k个字，
+再用bert语言模型一次前向同时验证这k个字，接受其中正确的前缀。
+week11中bert_sft.py的LanguageModel结构相同(bert + classify)，同样可以作为验证模型使用，
+但它生成时开头带[CLS]/[SEP](tokenizer.encode(openings))，需要传入add_special_tokens=True，
+保证验证时的输入与它生成时一致；草稿模型没有见过这两个特殊字符，接受率可能略低，结果不受影响。
+"""
+
+
+#草稿模型：课程最开始的LSTM语言模型，词表与bert共用，输出可以直接和bert对齐
+class DraftModel(nn.Module):
+    def __init__(self, input_dim, vocab_size):
+        super(DraftModel, self).__init__()
+        self.embedding = nn.Embedding(vocab_size, input_dim)
+        self.layer = nn.LSTM(input_dim, input_dim, num_layers=1, batch_first=True)
+        self.classify = nn.Linear(input_dim, vocab_size)
+        self.loss = nn.functional.cross_entropy
+
+    def forward(self, x, y=None, state=None):
+        x = self.embedding(x)
+        x, state = self.layer(x, state)
+        y_pred = self.classify(x)   #output shape:(batch_size, sen_len, vocab_size)
+        if y is not None:
+            return self.loss(y_pred.view(-1, y_pred.shape[-1]), y.view(-1))
+        return torch.softmax(y_pred, dim=-1), state
+
+#验证模型一次前向：第i行输入为 前缀 + 前i个草稿字
+#生成时bert不使用因果mask，每行都要和逐字生成时的输入完全一致，才能保证结果不变
+#行末补齐的padding通过attention_mask屏蔽，不影响前面位置的结果
+def verify_probs(model, prefix, draft_ids):
+    rows = [prefix + draft_ids[:i] for i in range(len(draft_ids) + 1)]
+    max_len = len(rows[-1])
+    x = torch.zeros((len(rows), max_len), dtype=torch.long)
+    attention_mask = torch.zeros((len(rows), max_len), dtype=torch.long)
+    for i, row in enumerate(rows):
+        x[i, :len(row)] = torch.LongTensor(row)
+        attention_mask[i, :len(row)] = 1
+    if torch.cuda.is_available():
+        x, attention_mask = x.cuda(), attention_mask.cuda()
+    sequence_output = model.bert(x, attention_mask=attention_mask)[0]
+    last_index = torch.LongTensor([len(row) - 1 for row in rows]).to(x.device)
+    last_output = sequence_output[torch.arange(len(rows), device=x.device), last_index]
+    return torch.softmax(model.classify(last_output), dim=-1)   #(k + 1, vocab_size)
+
+#草稿模型连续猜k个字，返回猜测的字和每一步的概率分布
+def draft_tokens(draft_model, prefix, k, strategy):
+    x = torch.LongTensor([prefix])
+    if torch.cuda.is_available():
+        x = x.cuda()
+    probs, state = draft_model(x)
+    prob = probs[0, -1]
+    draft_ids, draft_dists = [], []
+    for _ in range(k):
+        if strategy == "greedy":
+            index = int(torch.argmax(prob))
+        else:
+            index = int(torch.multinomial(prob, 1))
+        draft_ids.append(index)
+        draft_dists.append(prob)
+        probs, state = draft_model(torch.LongTensor([[index]]).to(x.device), state=state)
+        prob = probs[0, -1]
+    return draft_ids, draft_dists
+
+#对验证结果做接受/拒绝
+#greedy：草稿字等于bert的argmax才接受，否则取bert的argmax，与逐字greedy完全一致
+#sampling：以min(1, p/q)的概率接受，拒绝时从max(0, p - q)归一化后的分布中重采样，与直接从p采样同分布
+def accept_tokens(target_dists, draft_ids, draft_dists, strategy):
+    accepted = []
+    for i, index in enumerate(draft_ids):
+        p, q = target_dists[i], draft_dists[i]
+        if strategy == "greedy":
+            best = int(torch.argmax(p))
+            if best != index:
+                return accepted, best
+        else:
+            if torch.rand(1).item() >= min(1.0, (p[index] / q[index]).item()):
+                residual = torch.clamp(p - q, min=0)
+                return accepted, int(torch.multinomial(residual / residual.sum(), 1))
+        accepted.append(index)
+    #全部接受时，最后一行的结果可以再免费多生成一个字
+    last = target_dists[len(draft_ids)]
+    if strategy == "greedy":
+        return accepted, int(torch.argmax(last))
+    return accepted, int(torch.multinomial(last, 1))
+
+#投机解码生成
+#每轮：草稿模型猜k个字 -> bert一次前向验证 -> 接受前缀并补一个bert给出的字
+#add_special_tokens与验证模型生成时的编码方式一致：week10为False，week11的sft模型为True
+def speculative_generate(openings, model, draft_model, tokenizer, k=4, max_length=30,
+                         strategy="greedy", stop_ids=None, stats=None, add_special_tokens=False):
+    model.eval()
+    draft_model.eval()
+    stop_ids = set(stop_ids or [])
+    ids = tokenizer.encode(openings, add_special_tokens=add_special_tokens)
+    with torch.no_grad():
+        while len(ids) < max_length:
+            draft_ids, draft_dists = draft_tokens(draft_model, ids, min(k, max_length - len(ids)), strategy)
+            target_dists = verify_probs(model, ids, draft_ids)
+            accepted, next_id = accept_tokens(target_dists, draft_ids, draft_dists, strategy)
+            new_ids = accepted + [next_id]
+            if stats is not None:
+                stats["verify_steps"] += 1
+                stats["accepted"] += len(accepted)
+                stats["generated"] += len(new_ids)
+            for index in new_ids:
+                ids.append(index)
+                if index in stop_ids or len(ids) >= max_length:
+                    return tokenizer.decode(ids)
+    return tokenizer.decode(ids)
+
+#逐字生成，作为对照
+def greedy_generate(openings, model, tokenizer, max_length=30, stop_ids=None, add_special_tokens=False):
+    model.eval()
+    stop_ids = set(stop_ids or [])
+    ids = tokenizer.encode(openings, add_special_tokens=add_special_tokens)
+    with torch.no_grad():
+        while len(ids) < max_length:
+            x = torch.LongTensor([ids])
+            if torch.cuda.is_available():
+                x = x.cuda()
+            index = int(torch.argmax(model(x)[0][-1]))
+            ids.append(index)
+            if index in stop_ids:
+                break
+    return tokenizer.decode(ids)
+
+#训练草稿模型，数据构造与bert语言模型相同
+def train_draft(corpus, tokenizer, window_size=10, epoch_num=20, batch_size=128, train_sample=10000):
+    draft_model = DraftModel(256, tokenizer.vocab_size)
+    if torch.cuda.is_available():
+        draft_model = draft_model.cuda()
+    optim = torch.optim.Adam(draft_model.parameters(), lr=0.001)
+    for epoch in range(epoch_num):
+        draft_model.train()
+        watch_loss = []
+        for batch in range(int(train_sample / batch_size)):
+            x, y = build_dataset(batch_size, tokenizer, window_size, corpus)
+            if torch.cuda.is_available():
+                x, y = x.cuda(), y.cuda()
+            optim.zero_grad()
+            loss = draft_model(x, y)
+            loss.backward()
+            optim.step()
+            watch_loss.append(loss.item())
+        print("=========\n草稿模型第%d轮平均loss:%f" % (epoch + 1, np.mean(watch_loss)))
+    return draft_model
+
+#统计每次bert前向平均产出的字数，以及与逐字生成的耗时对比
+def benchmark(openings_list, model, draft_model, tokenizer, k=4, max_length=30, add_special_tokens=False):
+    stop_ids = [tokenizer.convert_tokens_to_ids("[SEP]")]
+    stats = {"verify_steps": 0, "accepted": 0, "generated": 0}
+    start_time = time.time()
+    for openings in openings_list:
+        speculative_text = speculative_generate(openings, model, draft_model, tokenizer, k, max_length,
+                                                "greedy", stop_ids, stats, add_special_tokens)
+    speculative_time = time.time() - start_time
+    start_time = time.time()
+    for openings in openings_list:
+        greedy_text = greedy_generate(openings, model, tokenizer, max_length, stop_ids, add_special_tokens)
+    greedy_time = time.time() - start_time
+    print("最后一条投机解码结果：", speculative_text)
+    print("最后一条逐字生成结果：", greedy_text)
+    print("验证次数：%d，平均每次接受草稿字数：%f，平均每次产出字数：%f" % (
+        stats["verify_steps"], stats["accepted"] / stats["verify_steps"], stats["generated"] / stats["verify_steps"]))
+    print("投机解码耗时：%f秒，逐字生成耗时：%f秒" % (speculative_time, greedy_time))
+    return stats
+
+
+if __name__ == "__main__":
+    pretrain_model_path = r'F:\Desktop\work_space\pretrain_models\bert-base-chinese'
+    corpus_path = r"F:/Desktop/work_space/badou/八斗课程/week10 文本生成问题/lstm语言模型生成文本/corpus.txt"
+    tokenizer = BertTokenizer.from_pretrained(pretrain_model_path)
+    corpus = load_corpus(corpus_path)
+    model = build_model(21128, 768, pretrain_model_path)
+    model.load_state_dict(torch.load("model/corpus.pth", map_location="cpu"))
+    if torch.cuda.is_available():
+        model = model.cuda()
+    draft_model = train_draft(corpus, tokenizer)
+    benchmark(["让他在半年之前，就不能做出", "李慕站在山路上，深深的呼吸"], model, draft_model, tokenizer)
@@ -10,6 +10,7 @@ import os
 import re
 from transformers import BertTokenizer, BertModel
 from torch.utils.data import Dataset, DataLoader
+from vocab_pruning import PrunedTokenizer, prune_model
 
 """
 基于Bert结构，进行sft形式的训练
@@ -137,7 +138,7 @@ def sampling_strategy(prob_distribution):
 
 
 
-def main(corpus_path, save_weight=True):
+def main(corpus_path, save_weight=True, prune_vocab=False):
     epoch_num = 20        #训练轮数
     batch_size = 32       #每次训练样本个数
     char_dim = 768        #每个字的维度
@@ -150,8 +151,14 @@ def main(corpus_path, save_weight=True):
     tokenizer = BertTokenizer.from_pretrained(pretrain_model_path)
 
     corpus = load_corpus(corpus_path)     #加载语料
+    if prune_vocab:
+        #只保留语料中出现过的token
+        tokenizer = PrunedTokenizer.from_corpus(tokenizer, [text for pair in corpus for text in pair])
+        print("词表由%d裁剪为%d" % (vocab_size, tokenizer.vocab_size))
     train_data = build_dataset(tokenizer, corpus, max_length, batch_size)  #建立数据集
     model = build_model(vocab_size, char_dim, pretrain_model_path)    #建立模型
+    if prune_vocab:
+        prune_model(model, tokenizer.kept_ids)
     if torch.cuda.is_available():
         model = model.cuda()
     optim = torch.optim.Adam(model.parameters(), lr=learning_rate)   #建立优化器
@@ -176,6 +183,8 @@ def main(corpus_path, save_weight=True):
         base_name = os.path.basename(corpus_path).replace("txt", "pth")
         model_path = os.path.join("model", base_name)
         torch.save(model.state_dict(), model_path)
+        if prune_vocab:
+            tokenizer.save(model_path.replace(".pth", "_vocab.json"))  #加载模型时需要同样的编号映射
         return
 
 
@@ -0,0 +1,72 @@
+#coding:utf8
+
+import json
+import torch
+import torch.nn as nn
+
+"""
+词表裁剪
+bert-base-chinese的词表有21128个token，领域语料中实际出现的只占一小部分
+扫描训练语料，只保留出现过的token（以及特殊token），重新编号，
+同时裁剪bert的词向量和输出层classify的权重，输出层的计算量和显存会成倍下降
+编码和解码时在新旧编号之间自动转换，训练和生成的代码不需要修改
+"""
+
+
+class PrunedTokenizer:
+    def __init__(self, tokenizer, kept_ids):
+        self.tokenizer = tokenizer
+        self.kept_ids = sorted(set(kept_ids) | set(tokenizer.all_special_ids))  #pad为0，排序后新编号仍为0
+        self.old_to_new = dict((old_id, new_id) for new_id, old_id in enumerate(self.kept_ids))
+        self.vocab_size = len(self.kept_ids)
+        self.unk_token_id = self.old_to_new[tokenizer.unk_token_id]
+        self.pad_token_id = self.old_to_new[tokenizer.pad_token_id]
+        self.cls_token_id = self.old_to_new[tokenizer.cls_token_id]
+        self.sep_token_id = self.old_to_new[tokenizer.sep_token_id]
+        self.mask_token_id = self.old_to_new[tokenizer.mask_token_id]
+
+    #扫描语料，统计出现过的token
+    @classmethod
+    def from_corpus(cls, tokenizer, texts):
+        kept_ids = set()
+        for text in texts:
+            kept_ids.update(tokenizer.encode(text, add_special_tokens=False))
+        return cls(tokenizer, kept_ids)
+
+    def encode(self, text, **kwargs):
+        ids = self.tokenizer.encode(text, **kwargs)
+        return [self.old_to_new.get(index, self.unk_token_id) for index in ids]
+
+    def decode(self, ids, **kwargs):
+        if hasattr(ids, "tolist"):  #tensor或numpy类型
+            ids = ids.tolist()
+        if isinstance(ids, int):
+            ids = [ids]
+        return self.tokenizer.decode([self.kept_ids[int(index)] for index in ids], **kwargs)
+
+    def save(self, path):
+        with open(path, "w", encoding="utf8") as f:
+            json.dump(self.kept_ids, f)
+
+    @classmethod
+    def load(cls, tokenizer, path):
+        with open(path, encoding="utf8") as f:
+            return cls(tokenizer, json.load(f))
+
+
+#按保留的token裁剪词向量和输出层，在加载预训练权重之后、训练之前调用
+def prune_model(model, kept_ids):
+    index = torch.LongTensor(kept_ids)
+    word_embeddings = model.bert.embeddings.word_embeddings
+    new_embeddings = nn.Embedding(len(kept_ids), word_embeddings.embedding_dim,
+                                  padding_idx=word_embeddings.padding_idx)
+    new_embeddings.weight.data = word_embeddings.weight.data[index].clone()
+    model.bert.embeddings.word_embeddings = new_embeddings
+    model.bert.config.vocab_size = len(kept_ids)
+
+    classify = model.classify
+    new_classify = nn.Linear(classify.in_features, len(kept_ids))
+    new_classify.weight.data = classify.weight.data[index].clone()
+    new_classify.bias.data = classify.bias.data[index].clone()
+    model.classify = new_classify
+    return model
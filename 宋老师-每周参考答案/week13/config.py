@@ -18,6 +18,8 @@ Config = {
     "optimizer": "adam",
     "learning_rate": 1e-3,
     "use_crf": False,
+    "bert_num_layers": None,  #bert只保留前几层，None为全部保留
+    "distill_epoch": 0,  #保留部分层时，微调前先用完整bert做几轮层蒸馏
     "class_num": 9,
     "bert_path": r"E:\pretrain_models\bert-base-chinese"
 }
\ No newline at end of file
@@ -2,12 +2,13 @@
 
 import torch
 import os
+import time
 import random
 import os
 import numpy as np
 import logging
 from config import Config
-from model import TorchModel, choose_optimizer
+from model import TorchModel, choose_optimizer, distill_bert_layers
 from evaluate import Evaluator
 from loader import load_data
 from peft import get_peft_model, LoraConfig, TaskType
@@ -37,6 +38,11 @@ def main(config):
     train_data = load_data(config["train_data_path"], config)
     #加载模型
     model = TorchModel(config)
+    #只保留了部分bert层时，先用完整的bert做层蒸馏，再包装lora微调
+    if config.get("distill_epoch") and config.get("bert_num_layers"):
+        if torch.cuda.is_available():
+            model = model.cuda()
+        distill_bert_layers(model.bert, config["bert_path"], train_data, config, logger)
     model = peft_wrapper(model)
     # 标识是否使用gpu
     cuda_flag = torch.cuda.is_available()
@@ -71,5 +77,43 @@ def main(config):
     
     return model, train_data
 
+#在验证集上测量平均每个batch的推理耗时，单位毫秒
+def measure_latency(model, data, max_batch=50):
+    model.eval()
+    cost = []
+    with torch.no_grad():
+        for index, batch_data in enumerate(data):
+            if index >= max_batch:
+                break
+            input_id = batch_data[0]
+            if torch.cuda.is_available():
+                input_id = input_id.cuda()
+            start_time = time.time()
+            model(input_id)
+            cost.append(time.time() - start_time)
+    return sum(cost) / max(len(cost), 1) * 1000
+
+#F1-耗时曲线：bert只保留前n层分别训练，记录训练后的Micro-F1和验证集上平均每个batch的推理耗时
+#min_f1不为None时，给出满足F1要求的最少层数
+def depth_curve(config, depths, min_f1=None, max_batch=50):
+    report = []
+    for num_layers in depths:
+        depth_config = dict(config, bert_num_layers=num_layers)
+        model, train_data = main(depth_config)
+        evaluator = Evaluator(depth_config, model, logger)
+        micro_f1 = evaluator.eval(depth_config["epoch"])
+        latency = measure_latency(model, evaluator.valid_data, max_batch)
+        logger.info("bert层数：%d，Micro-F1：%f，平均每个batch耗时：%f毫秒" % (num_layers, micro_f1, latency))
+        report.append({"bert_num_layers": num_layers, "micro_f1": micro_f1, "latency_ms": latency})
+    if min_f1 is not None:
+        passed = [result for result in report if result["micro_f1"] >= min_f1]
+        if passed:
+            best = min(passed, key=lambda x: x["latency_ms"])
+            logger.info("Micro-F1不低于%f的最快配置：保留%d层" % (min_f1, best["bert_num_layers"]))
+        else:
+            logger.info("没有层数满足Micro-F1不低于%f" % min_f1)
+    return report
+
 if __name__ == "__main__":
     model, train_data = main(Config)
+    # depth_curve(Config, [2, 4, 6, 8, 12], min_f1=0.8)
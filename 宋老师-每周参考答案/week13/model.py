@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import torch
+import numpy as np
 import torch.nn as nn
 from torch.optim import Adam, SGD
 from torchcrf import CRF
@@ -25,6 +26,7 @@ class TorchModel(nn.Module):
         # self.embedding = nn.Embedding(vocab_size, hidden_size, padding_idx=0)
         # self.layer = nn.LSTM(hidden_size, hidden_size, batch_first=True, bidirectional=True, num_layers=num_layers)
         self.bert = BertModel.from_pretrained(config["bert_path"], return_dict=False)
+        self.bert = keep_bert_layers(self.bert, config.get("bert_num_layers"))  #只保留前几层
         self.classify = nn.Linear(self.bert.config.hidden_size, class_num)
         self.crf_layer = CRF(class_num, batch_first=True)
         self.use_crf = config["use_crf"]
@@ -50,6 +52,36 @@ class TorchModel(nn.Module):
             else:
                 return predict
 
+#只保留bert的前num_layers个transformer层，后面的层直接删掉，计算量和参数量随层数线性下降
+def keep_bert_layers(bert, num_layers):
+    if num_layers is not None and num_layers < bert.config.num_hidden_layers:
+        bert.encoder.layer = nn.ModuleList(list(bert.encoder.layer)[:num_layers])
+        bert.config.num_hidden_layers = num_layers
+    return bert
+
+#层蒸馏：以完整的bert为老师，让只保留前几层的bert最后一层的输出拟合完整bert最后一层的输出(MSE)
+#在任务微调之前运行，只用到输入文本，不需要标签
+def distill_bert_layers(student, teacher_path, data, config, logger):
+    device = next(student.parameters()).device
+    teacher = BertModel.from_pretrained(teacher_path, return_dict=False).to(device).eval()
+    for param in teacher.parameters():
+        param.requires_grad = False
+    optimizer = Adam(student.parameters(), lr=config["learning_rate"])
+    for epoch in range(config["distill_epoch"]):
+        student.train()
+        distill_loss = []
+        for batch_data in data:
+            input_ids = batch_data[0].to(device)
+            with torch.no_grad():
+                target = teacher(input_ids)[0]
+            loss = nn.functional.mse_loss(student(input_ids)[0], target)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            distill_loss.append(loss.item())
+        logger.info("层蒸馏第%d轮 平均loss：%f" % (epoch + 1, np.mean(distill_loss)))
+    return student
+
 
 def choose_optimizer(config, model):
     optimizer = config["optimizer"]
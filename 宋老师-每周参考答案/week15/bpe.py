@@ -1,4 +1,13 @@
 import os
+import re
+import heapq
+import collections
+import functools
+import concurrent.futures
+import mmap
+import array
+import struct
+import copyreg
 
 '''
 bpe构建词表示范
@@ -22,25 +31,79 @@ def merge(ids, pair, idx):
             i += 1
     return newids
 
-def build_vocab(text):
-    vocab_size = 500 # 超参数：预期的最终词表大小，根据实际情况自己设置，大的词表会需要大的embedding层
+#预切分的正则：英文缩写、连续的字母/汉字、数字、标点、空白分别成块，合并不会跨越块的边界
+#同一个块在语料中重复出现时只需要处理一次，按出现次数加权即可
+SPLIT_PATTERN = re.compile(r"""'(?:[sdmt]|ll|ve|re)| ?[^\W\d_]+| ?\d{1,3}| ?(?:[^\s\w]|_)+|\s+(?!\S)|\s+""")
+
+#统计每个块出现的次数，返回块的字节序列列表和对应次数
+def count_chunks(text, pattern=SPLIT_PATTERN):
+    chunks = collections.Counter(pattern.findall(text)) if pattern is not None else collections.Counter([text])
+    words = [list(chunk.encode("utf-8")) for chunk in chunks]
+    counts = list(chunks.values())
+    return words, counts
+
+#增量式训练：
+#pair_counts记录每个pair的加权次数，where记录pair出现在哪些块中，heap按次数取最大的pair
+#每次合并只重新统计包含该pair的块，其他块不用动
+#合并(a, b)->x只会减少已有pair的次数，新增的pair一定包含x，所以堆里过期的记录在弹出时校验即可
+def build_vocab(text, vocab_size=500, pattern=SPLIT_PATTERN, verbose=True):
+    # vocab_size 超参数：预期的最终词表大小，根据实际情况自己设置，大的词表会需要大的embedding层
     num_merges = vocab_size - 256
-    tokens = text.encode("utf-8") # raw bytes
-    tokens = list(map(int, tokens))
-    ids = list(tokens) 
+    words, counts = count_chunks(text, pattern)
+
+    pair_counts = collections.defaultdict(int)  # (int, int) -> 加权次数
+    where = collections.defaultdict(set)        # (int, int) -> 包含该pair的块下标
+    for word_index, (word, count) in enumerate(zip(words, counts)):
+        for pair in zip(word, word[1:]):
+            pair_counts[pair] += count
+            where[pair].add(word_index)
+    heap = [(-count, pair) for pair, count in pair_counts.items()]
+    heapq.heapify(heap)
 
     merges = {} # (int, int) -> int
     for i in range(num_merges):
-        stats = get_stats(ids)
-        pair = max(stats, key=stats.get)
+        pair = None
+        while heap:
+            neg_count, candidate = heapq.heappop(heap)
+            current = pair_counts.get(candidate, 0)
+            if current == -neg_count:
+                pair = candidate
+                break
+            if current > 0:
+                heapq.heappush(heap, (-current, candidate))  #次数已变少，按当前次数重新入堆
+        if pair is None:
+            break # 语料中已经没有可以合并的pair
         idx = 256 + i
-        print(f"merging {pair} into a new token {idx}")
-        ids = merge(ids, pair, idx)
+        if verbose:
+            print(f"merging {pair} into a new token {idx}")
+        changed = set()
+        for word_index in where.pop(pair):
+            word, count = words[word_index], counts[word_index]
+            old_stats = get_stats(word)
+            word = merge(word, pair, idx)
+            words[word_index] = word
+            new_stats = get_stats(word)
+            for p in old_stats.keys() | new_stats.keys():
+                diff = new_stats.get(p, 0) - old_stats.get(p, 0)
+                if diff == 0:
+                    continue
+                pair_counts[p] += diff * count
+                changed.add(p)
+                if p not in new_stats:
+                    where[p].discard(word_index)
+                else:
+                    where[p].add(word_index)
+        del pair_counts[pair]
+        for p in changed:
+            if p != pair and pair_counts[p] > 0 and idx in p:
+                heapq.heappush(heap, (-pair_counts[p], p))
         merges[pair] = idx
-    
+
     vocab = {idx: bytes([idx]) for idx in range(256)}
     for (p0, p1), idx in merges.items():
         vocab[idx] = vocab[p0] + vocab[p1]
+        if not verbose:
+            continue
         try:
             # 将unicode编码转换为可读的字符,打印出来看一看
             print(idx, vocab[idx].decode("utf8"))
@@ -61,17 +124,218 @@ def decode(ids, vocab):
     return text
 
 #解码过程
+#按rank(即合并产生的新token编号，越小越先合并)依次合并，结果与逐轮统计全部pair再合并完全一致
 def encode(text, merges):
     # given a string, return list of integers (the tokens)
-    tokens = list(text.encode("utf-8"))
-    while len(tokens) >= 2:
-        stats = get_stats(tokens)
-        pair = min(stats, key=lambda p: merges.get(p, float("inf")))
-        if pair not in merges:
-            break # nothing else can be merged
-        idx = merges[pair]
-        tokens = merge(tokens, pair, idx)
-    return tokens
+    return merge_by_rank(list(text.encode("utf-8")), merges)
+
+#用双向链表+小根堆完成合并，复杂度O(n log n)
+#堆中记录(rank, 位置)，同一rank按位置从左到右弹出，和merge函数从左往右不重叠地合并一致
+#合并后只有左右两个邻居组成的新pair需要入堆；新pair一定包含新token，rank必然比当前的大
+#堆中过期的记录(位置已被合并掉，或该位置的pair已经变了)弹出时跳过
+def merge_by_rank(tokens, merges):
+    n = len(tokens)
+    if n < 2:
+        return list(tokens)
+    values = list(tokens)
+    left = list(range(-1, n - 1))
+    right = list(range(1, n + 1))
+    right[-1] = -1
+    alive = [True] * n
+    heap = []
+    for i in range(n - 1):
+        rank = merges.get((values[i], values[i + 1]))
+        if rank is not None:
+            heap.append((rank, i))
+    heapq.heapify(heap)
+    while heap:
+        rank, i = heapq.heappop(heap)
+        j = right[i]
+        if not alive[i] or j == -1 or merges.get((values[i], values[j])) != rank:
+            continue
+        values[i] = rank
+        alive[j] = False
+        right[i] = right[j]
+        if right[j] != -1:
+            left[right[j]] = i
+        if left[i] != -1:
+            new_rank = merges.get((values[left[i]], values[i]))
+            if new_rank is not None:
+                heapq.heappush(heap, (new_rank, left[i]))
+        if right[i] != -1:
+            new_rank = merges.get((values[i], values[right[i]]))
+            if new_rank is not None:
+                heapq.heappush(heap, (new_rank, i))
+    return [values[i] for i in range(n) if alive[i]]
+
+
+#编码器：先按正则切块，每个块单独合并，块的结果放进LRU缓存，重复出现的词不用再算
+#pattern需要和训练时保持一致；pattern=None时整段文本作为一个块，与encode函数结果相同
+class Tokenizer:
+    def __init__(self, merges, pattern=SPLIT_PATTERN, cache_size=100000, vocab=None):
+        self.merges = merges
+        self.pattern = pattern
+        self.cache_size = cache_size
+        self.vocab = vocab
+        if self.vocab is None:
+            self.vocab = {idx: bytes([idx]) for idx in range(256)}
+            for (p0, p1), idx in sorted(merges.items(), key=lambda item: item[1]):
+                self.vocab[idx] = self.vocab[p0] + self.vocab[p1]
+        self.build_cache()
+
+    def build_cache(self):
+        self.encode_chunk = functools.lru_cache(maxsize=self.cache_size)(self._encode_chunk)
+
+    def _encode_chunk(self, chunk):
+        return tuple(merge_by_rank(list(chunk.encode("utf-8")), self.merges))
+
+    def encode(self, text):
+        if self.pattern is None:
+            return list(self.encode_chunk(text))
+        ids = []
+        for chunk in self.pattern.findall(text):
+            ids.extend(self.encode_chunk(chunk))
+        return ids
+
+    #批量编码，默认线程池；纯python计算受GIL限制，文本量大时可以用进程池
+    def encode_batch(self, texts, workers=None, use_process=False):
+        if use_process:
+            with concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(self,)) as pool:
+                return list(pool.map(_encode_in_worker, texts, chunksize=64))
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            return list(pool.map(self.encode, texts))
+
+    def decode(self, ids):
+        return decode(ids, self.vocab)
+
+    #缓存是绑定在实例上的函数，不能被pickle，传给子进程时去掉，到子进程再重建
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["encode_chunk"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.build_cache()
+
+#进程池中每个进程持有一份tokenizer，只在进程启动时传一次
+_worker_tokenizer = None
+
+def _init_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+def _encode_in_worker(text):
+    return _worker_tokenizer.encode(text)
+
+
+#词表文件格式，所有整数为小端序：
+#  头部：   魔数b"BPE1"，版本号，merge数量n，正则长度，正则文本(utf-8，长度为0表示不切块)，补齐到8字节
+#  pairs：  n个(uint32, uint32)，按合并顺序排列
+#  offsets：256 + n + 1个uint32，每个token的字节串在blob中的起止位置
+#  blob：   所有token字节串首尾相接
+#文件用mmap打开，加载时不需要解析，多个进程打开同一文件共享操作系统的页缓存
+MODEL_MAGIC = b"BPE1"
+MODEL_VERSION = 1
+HEADER_FORMAT = "<4sIII"
+
+def _align(offset, size=8):
+    return (offset + size - 1) // size * size
+
+def save_model(path, merges, pattern=SPLIT_PATTERN):
+    ordered = sorted(merges.items(), key=lambda item: item[1])
+    assert all(idx == 256 + i for i, (_, idx) in enumerate(ordered)), "merge编号需要从256开始连续"
+    pattern_bytes = pattern.pattern.encode("utf-8") if pattern is not None else b""
+    vocab = [bytes([idx]) for idx in range(256)]
+    for (p0, p1), idx in ordered:
+        vocab.append(vocab[p0] + vocab[p1])
+    offsets = [0]
+    for token in vocab:
+        offsets.append(offsets[-1] + len(token))
+
+    header = struct.pack(HEADER_FORMAT, MODEL_MAGIC, MODEL_VERSION, len(ordered), len(pattern_bytes)) + pattern_bytes
+    with open(path, "wb") as f:
+        f.write(header + b"\0" * (_align(len(header)) - len(header)))
+        f.write(array.array("I", [p for pair, _ in ordered for p in pair]).tobytes())
+        f.write(array.array("I", offsets).tobytes())
+        f.write(b"".join(vocab))
+
+#映射后的文件，按格式切出各段的memoryview
+class MappedModel:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.buffer)
+        magic, version, num_merges, pattern_length = struct.unpack_from(HEADER_FORMAT, self.buffer)
+        assert magic == MODEL_MAGIC and version == MODEL_VERSION, "不是bpe词表文件：%s" % path
+        offset = struct.calcsize(HEADER_FORMAT)
+        pattern = bytes(view[offset:offset + pattern_length]).decode("utf-8")
+        self.pattern = re.compile(pattern) if pattern else None
+        offset = _align(offset + pattern_length)
+        self.num_merges = num_merges
+        self.pairs = view[offset:offset + 8 * num_merges].cast("I")
+        offset += 8 * num_merges
+        self.offsets = view[offset:offset + 4 * (256 + num_merges + 1)].cast("I")
+        offset += 4 * (256 + num_merges + 1)
+        self.blob = view[offset:]
+
+#merges的只读视图，接口与dict一致，可以直接传给merge_by_rank
+#pair -> rank的查找表在第一次查找时才从映射的pairs构建，只加载不编码的进程不需要付出这部分开销
+class MappedMerges:
+    def __init__(self, model):
+        self.model = model
+        self.ranks = None
+
+    def get(self, pair, default=None):
+        if self.ranks is None:
+            pairs = self.model.pairs
+            self.ranks = dict(((pairs[2 * i], pairs[2 * i + 1]), 256 + i) for i in range(self.model.num_merges))
+        return self.ranks.get(pair, default)
+
+    #传给子进程时不带已经构建的查找表，子进程按需重建
+    def __getstate__(self):
+        return {"model": self.model, "ranks": None}
+
+    def __contains__(self, pair):
+        return self.get(pair) is not None
+
+    def __getitem__(self, pair):
+        rank = self.get(pair)
+        if rank is None:
+            raise KeyError(pair)
+        return rank
+
+    def __len__(self):
+        return self.model.num_merges
+
+    def items(self):
+        pairs = self.model.pairs
+        for i in range(self.model.num_merges):
+            yield (pairs[2 * i], pairs[2 * i + 1]), 256 + i
+
+#vocab的只读视图，取出的字节串直接来自映射的内存
+class MappedVocab:
+    def __init__(self, model):
+        self.model = model
+
+    def __getitem__(self, idx):
+        offsets = self.model.offsets
+        return bytes(self.model.blob[offsets[idx]:offsets[idx + 1]])
+
+    def __len__(self):
+        return len(self.model.offsets) - 1
+
+#加载词表文件，返回可以直接编解码的Tokenizer
+#Tokenizer被pickle到子进程时只传文件路径，子进程重新映射同一个文件
+def load_model(path, cache_size=100000):
+    model = MappedModel(path)
+    return Tokenizer(MappedMerges(model), model.pattern, cache_size, MappedVocab(model))
+
+def _reduce_mapped_model(model):
+    return MappedModel, (model.path,)
+
+copyreg.pickle(MappedModel, _reduce_mapped_model)
 
 
 if __name__ == "__main__":
@@ -85,9 +349,12 @@ if __name__ == "__main__":
             corpus += text + '\n'
     #构建词表
     merges, vocabs = build_vocab(corpus)
+    #保存词表文件，之后直接加载即可使用
+    save_model("bpe.model", merges)
+    tokenizer = load_model("bpe.model")
     #使用词表进行编解码
     string = "矮人直升机"
-    encode_ids = encode(string, merges)
+    encode_ids = tokenizer.encode(string)
     print("编码结果：", encode_ids)
     decode_string = decode(encode_ids, vocabs)
     print("解码结果：", decode_string)
\ No newline at end of file
@@ -0,0 +1,141 @@
+import os
+import hashlib
+import json
+import time
+import asyncio
+import tracemalloc
+from collections import OrderedDict
+from ds import DialogSystem
+
+'''
+多会话对话服务
+DialogSystem加载的场景图、槽位模板在所有会话之间共享，只读不写
+每个会话的memory保存在会话存储中：LRU + 过期淘汰，可选把淘汰的会话快照到磁盘，下次访问时恢复
+协议：每行一个json请求 {"session": 会话id, "query": 用户输入}，返回一行json {"session":..., "reply":...}
+'''
+
+class SessionStore:
+    def __init__(self, max_sessions=10000, ttl=1800, snapshot_dir=None):
+        self.max_sessions = max_sessions
+        self.ttl = ttl  #秒，超过这么久没有交互的会话被淘汰
+        self.snapshot_dir = snapshot_dir
+        self.sessions = OrderedDict()  #key = 会话id， value = [最近访问时间, memory]
+        if snapshot_dir is not None:
+            os.makedirs(snapshot_dir, exist_ok=True)
+
+    def snapshot_path(self, session_id):
+        #会话id来自客户端，不直接作为文件名
+        return os.path.join(self.snapshot_dir, "%s.json" % hashlib.md5(session_id.encode("utf8")).hexdigest())
+
+    def get(self, session_id):
+        if session_id in self.sessions:
+            self.sessions.move_to_end(session_id)
+            return self.sessions[session_id][1]
+        memory = {}
+        if self.snapshot_dir is not None and os.path.exists(self.snapshot_path(session_id)):
+            with open(self.snapshot_path(session_id), encoding="utf8") as f:
+                memory = json.load(f)
+            os.remove(self.snapshot_path(session_id))
+        return memory
+
+    def put(self, session_id, memory):
+        self.sessions[session_id] = [time.time(), memory]
+        self.sessions.move_to_end(session_id)
+        self.evict()
+
+    #先淘汰过期的，再按LRU淘汰超出容量的；OrderedDict头部就是最久没访问的会话
+    def evict(self):
+        now = time.time()
+        while self.sessions:
+            session_id, (last_time, memory) = next(iter(self.sessions.items()))
+            if now - last_time < self.ttl and len(self.sessions) <= self.max_sessions:
+                break
+            self.sessions.popitem(last=False)
+            if self.snapshot_dir is not None:
+                with open(self.snapshot_path(session_id), "w", encoding="utf8") as f:
+                    json.dump(memory, f, ensure_ascii=False)
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+class DialogServer:
+    def __init__(self, dialog_system, store):
+        self.ds = dialog_system
+        self.store = store
+
+    #run是同步计算，取出memory、运行、写回之间没有await，同一会话的请求不会交错执行
+    async def handle(self, session_id, query):
+        memory = self.store.get(session_id)
+        memory = self.ds.run(query, memory)
+        self.store.put(session_id, memory)
+        return memory["reply"]
+
+    #单行请求出错时返回 {"error": ...}，连接继续服务；连接断开时总会关闭
+    async def serve_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    session_id, query = request["session"], request["query"]
+                except (ValueError, KeyError, TypeError) as e:
+                    response = {"error": "请求格式错误：%r" % e}
+                else:
+                    try:
+                        response = {"session": session_id, "reply": await self.handle(session_id, query)}
+                    except Exception as e:
+                        response = {"session": session_id, "error": "处理失败：%r" % e}
+                writer.write((json.dumps(response, ensure_ascii=False) + "\n").encode("utf8"))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def serve(self, host="127.0.0.1", port=8765):
+        server = await asyncio.start_server(self.serve_client, host, port)
+        print("对话服务已启动：%s:%d" % (host, port))
+        async with server:
+            await server.serve_forever()
+
+
+#回放压测：num_sessions个会话并发，每个会话按顺序回放一段对话
+#统计每秒处理的轮数，以及会话存储中平均每个会话占用的内存
+async def replay_load_test(server, conversations, num_sessions=1000):
+    async def replay(session_id, queries):
+        for query in queries:
+            await server.handle(session_id, query)
+            await asyncio.sleep(0)  #让出事件循环，模拟多个会话交替到达
+        return len(queries)
+
+    tracemalloc.start()
+    start_memory = tracemalloc.get_traced_memory()[0]
+    start_time = time.time()
+    turns = await asyncio.gather(*[replay("session%d" % i, conversations[i % len(conversations)])
+                                   for i in range(num_sessions)])
+    cost_time = time.time() - start_time
+    session_memory = (tracemalloc.get_traced_memory()[0] - start_memory) / max(len(server.store), 1)
+    tracemalloc.stop()
+    print("会话数：%d，总轮数：%d，耗时：%f秒，每秒轮数：%f" % (num_sessions, sum(turns), cost_time, sum(turns) / cost_time))
+    print("存活会话数：%d，平均每个会话内存：%f字节" % (len(server.store), session_memory))
+    return sum(turns) / cost_time, session_memory
+
+
+if __name__ == '__main__':
+    import sys
+    server = DialogServer(DialogSystem(), SessionStore(snapshot_dir="session_snapshot"))
+    if len(sys.argv) > 1 and sys.argv[1] == "test":
+        conversations = [
+            ["我要买衣服", "长袖", "红色", "xl", "你说啥", "我买了"],
+            ["我要买衣服", "短袖红色", "你说啥", "m", "我没钱", "可以分期付款吗", "12期", "微信"],
+        ]
+        asyncio.run(replay_load_test(server, conversations))
+    else:
+        asyncio.run(server.serve())
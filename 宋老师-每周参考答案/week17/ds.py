@@ -1,7 +1,10 @@
 
+import os
 import json
-import pandas
 import re
+import zipfile
+import xml.etree.ElementTree as ET
+from collections import defaultdict
 
 
 '''
@@ -9,19 +12,99 @@ import re
 基于场景脚本完成多轮对话
 '''
 
+#意图索引：加载时把所有节点的意图文本预处理一次
+#字 -> 包含这个字的意图编号 的倒排表，查询时只遍历query中出现的字，得到每条意图与query的交集大小
+#jaccard = 交集 / (query字数 + 意图字数 - 交集)，不需要再为每条意图构建set
+class IntentIndex:
+    def __init__(self, all_node_info):
+        self.node_rows = {}  #key = 节点id， value = 该节点的意图编号列表
+        self.row_sizes = []  #每条意图去重后的字数
+        self.char_rows = defaultdict(list)  #key = 字， value = 包含这个字的意图编号
+        for node_id, node_info in all_node_info.items():
+            rows = []
+            for intent in node_info.get("intent", []):
+                row = len(self.row_sizes)
+                chars = set(intent)
+                self.row_sizes.append(len(chars))
+                for char in chars:
+                    self.char_rows[char].append(row)
+                rows.append(row)
+            self.node_rows[node_id] = rows
+
+    #query与每条意图的交集大小，没有交集的意图不出现在结果中
+    def intersect_counts(self, query_chars):
+        counts = defaultdict(int)
+        for char in query_chars:
+            for row in self.char_rows.get(char, []):
+                counts[row] += 1
+        return counts
+
+    #节点得分为其所有意图jaccard相似度的最大值
+    def node_score(self, node_id, query_size, counts):
+        scores = []
+        for row in self.node_rows[node_id]:
+            intersect = counts.get(row, 0)
+            union = query_size + self.row_sizes[row] - intersect
+            scores.append(intersect / union if union else 0)
+        return max(scores)
+
+
+#不依赖pandas/openpyxl读取xlsx第一个sheet，返回按表头组成的dict列表
+#xlsx是一个zip包：workbook.xml中第一个sheet通过关系文件找到对应的sheet xml，字符串单元格的内容存在sharedStrings.xml
+XLSX_NS = {"main": "http://schemas.openxmlformats.org/spreadsheetml/2006/main",
+           "rel": "http://schemas.openxmlformats.org/package/2006/relationships"}
+XLSX_REL_ID = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id"
+
+def read_xlsx(path):
+    with zipfile.ZipFile(path) as z:
+        shared_strings = []
+        if "xl/sharedStrings.xml" in z.namelist():
+            for si in ET.fromstring(z.read("xl/sharedStrings.xml")).findall("main:si", XLSX_NS):
+                shared_strings.append("".join(t.text or "" for t in si.iter("{%s}t" % XLSX_NS["main"])))
+        first_sheet = ET.fromstring(z.read("xl/workbook.xml")).find("main:sheets/main:sheet", XLSX_NS)
+        rels = ET.fromstring(z.read("xl/_rels/workbook.xml.rels"))
+        target = [rel.get("Target") for rel in rels.findall("rel:Relationship", XLSX_NS)
+                  if rel.get("Id") == first_sheet.get(XLSX_REL_ID)][0]
+        sheet = ET.fromstring(z.read("xl/" + target.lstrip("/").replace("xl/", "", 1)))
+    rows = []
+    for row in sheet.iter("{%s}row" % XLSX_NS["main"]):
+        values = {}
+        for cell in row.findall("main:c", XLSX_NS):
+            column = re.match("[A-Z]+", cell.get("r")).group()
+            if cell.get("t") == "inlineStr":
+                values[column] = "".join(t.text or "" for t in cell.iter("{%s}t" % XLSX_NS["main"]))
+                continue
+            v = cell.find("main:v", XLSX_NS)
+            if v is None:
+                continue
+            values[column] = shared_strings[int(v.text)] if cell.get("t") == "s" else v.text
+        rows.append(values)
+    header = rows[0]
+    return [dict((name, row.get(column)) for column, name in header.items()) for row in rows[1:]]
+
+
 class DialogSystem:
     def __init__(self):
         self.load()
 
     def load(self):
         self.all_node_info = {}  #key = 节点id， value = node info
-        self.load_scenrio("scenario-买衣服.json")
-        self.load_scenrio("scenario-看电影.json")
         self.slot_info = {} #key = slot, value = [反问，可能取值]
-        self.load_templet()
+        scenario_paths = ["scenario-买衣服.json", "scenario-看电影.json"]
+        templet_path = "./slot_fitting_templet.xlsx"
+        #场景和模板编译成一个json文件，源文件没有变化时直接加载编译结果
+        if not self.load_bundle("dialog_bundle.json", scenario_paths + [templet_path]):
+            for path in scenario_paths:
+                self.load_scenrio(path)
+            self.load_templet(templet_path)
 
-        #初始化一个专门的节点用于实现在任意时刻的重听
-        self.init_repeat_node()
+            #初始化一个专门的节点用于实现在任意时刻的重听
+            self.init_repeat_node()
+            self.save_bundle("dialog_bundle.json", scenario_paths + [templet_path])
+        #所有节点加载完成后构建意图索引
+        self.intent_index = IntentIndex(self.all_node_info)
+        #预编译每个节点的槽位抽取正则和回复模板
+        self.compile_nodes()
     
     #实现思路：一个重听节点可以是所有节点的子节点
     def init_repeat_node(self):
@@ -48,14 +131,55 @@ class DialogSystem:
                 node_info["childnode"] = [scenario_name + "-" + child for child in node_info["childnode"]]
             self.all_node_info[node_id] = node_info
     
-    def load_templet(self):
-        df = pandas.read_excel("./slot_fitting_templet.xlsx")
-        for i in range(len(df)):
-            slot = df["slot"][i]
-            query = df["query"][i]
-            values = df["values"][i]
+    def load_templet(self, path="./slot_fitting_templet.xlsx"):
+        for row in read_xlsx(path):
+            slot = row["slot"]
+            if slot is None:  #跳过只有格式没有内容的空行
+                continue
+            query = row["query"]
+            values = row["values"]
             self.slot_info[slot] = [query, values]
 
+    #编译结果中记录每个源文件的修改时间，任意一个变化都需要重新编译
+    def load_bundle(self, bundle_path, source_paths):
+        if not os.path.exists(bundle_path):
+            return False
+        with open(bundle_path, encoding="utf-8") as f:
+            bundle = json.load(f)
+        if bundle["sources"] != dict((path, os.path.getmtime(path)) for path in source_paths):
+            return False
+        self.all_node_info = bundle["all_node_info"]
+        self.slot_info = bundle["slot_info"]
+        return True
+
+    #节点信息中已经包含加上场景前缀的子节点列表和重听节点，加载后不需要再处理
+    def save_bundle(self, bundle_path, source_paths):
+        bundle = {"sources": dict((path, os.path.getmtime(path)) for path in source_paths),
+                  "all_node_info": self.all_node_info,
+                  "slot_info": self.slot_info}
+        with open(bundle_path, "w", encoding="utf-8") as f:
+            json.dump(bundle, f, ensure_ascii=False)
+
+    #槽位抽取：一个节点的所有槽位合成一个正则，每个槽位是一个带名字的零宽先行断言
+    #扫描一遍query，每个位置上哪些槽位能匹配都会被捕获，取每个槽位第一次出现的位置，
+    #结果与逐个槽位re.search相同
+    #回复模板：按槽位名切分成片段，奇数位置是槽位名，生成回复时直接拼接
+    def compile_nodes(self):
+        self.node_slot_regex = {}  #key = 节点id， value = (合并后的正则, 分组名 -> 槽位)
+        self.node_response = {}    #key = 节点id， value = 模板片段列表
+        for node_id, node_info in self.all_node_info.items():
+            slots = node_info.get("slot", [])
+            if not slots:
+                continue
+            group_slot = dict(("s%d" % i, slot) for i, slot in enumerate(slots))
+            pattern = "".join("(?:(?=(?P<%s>%s))|)" % (group, self.slot_info[slot][1])
+                              for group, slot in group_slot.items())
+            self.node_slot_regex[node_id] = (re.compile(pattern), group_slot)
+            if "response" in node_info:
+                #长的槽位名优先，避免一个槽位名是另一个的子串时切错
+                slot_pattern = "|".join(re.escape(slot) for slot in sorted(slots, key=len, reverse=True))
+                self.node_response[node_id] = re.split("(%s)" % slot_pattern, node_info["response"])
+
     def run(self, query, memory):
         if memory == {}:
             memory = self.init_memory()
@@ -76,8 +200,11 @@ class DialogSystem:
         # 获取意图
         hit_node = None
         hit_score = -1
+        query_chars = set(memory["query"])
+        #一次性得到query与所有意图的交集大小，各个节点的得分直接由此计算
+        counts = self.intent_index.intersect_counts(query_chars)
         for node_id in memory["available_node"]:
-            score = self.get_node_score(node_id, memory)
+            score = self.intent_index.node_score(node_id, len(query_chars), counts)
             if score > hit_score:
                 hit_node = node_id
                 hit_score = score
@@ -85,32 +212,21 @@ class DialogSystem:
         memory["hit_score"] = hit_score
         return memory
     
-    def get_node_score(self, node_id, memory):
-        #计算意图得分
-        intent_list = self.all_node_info[node_id]["intent"]
-        query = memory["query"]
-        scores = []
-        for intent in intent_list:
-            score = self.similarity(query, intent)  
-            scores.append(score) 
-        return max(scores) 
-    
-    def similarity(self, query, intent):
-        #文本相似度计算，使用jaccard距离
-        intersect = len(set(query) & set(intent))
-        union = len(set(query) | set(intent))
-        return intersect / union
-
-
     def get_slot(self, memory):
         # 获取槽位
         hit_node = memory["hit_node"]
-        for slot in self.all_node_info[hit_node].get("slot", []):
-            if slot not in memory:
-                values = self.slot_info[slot][1]
-                info = re.search(values, memory["query"])
-                if info is not None:
-                    memory[slot] = info.group()
+        if hit_node not in self.node_slot_regex:
+            return memory
+        regex, group_slot = self.node_slot_regex[hit_node]
+        missing = set(slot for slot in group_slot.values() if slot not in memory)
+        for match in regex.finditer(memory["query"]):
+            if not missing:
+                break
+            for group, value in match.groupdict().items():
+                slot = group_slot[group]
+                if value is not None and slot in missing:
+                    memory[slot] = value
+                    missing.discard(slot)
         return memory
 
     def dst(self, memory):
@@ -159,11 +275,12 @@ class DialogSystem:
         return memory
 
     def replace_templet(self, reply, memory):
-        #替换模板中的槽位
+        #替换模板中的槽位，使用加载时切分好的模板片段
         hit_node = memory["hit_node"]
-        for slot in self.all_node_info[hit_node].get("slot", []):
-            reply = re.sub(slot, memory[slot], reply)
-        return reply
+        if hit_node not in self.node_response:
+            return reply
+        segments = self.node_response[hit_node]
+        return "".join(memory[segment] if i % 2 else segment for i, segment in enumerate(segments))
 
 
 
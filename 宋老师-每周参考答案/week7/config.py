@@ -16,7 +16,19 @@ Config = {
     "num_layers": 2,
     "epoch": 5,
     "batch_size": 16,
-    "pooling_style":"avg",
+    "pooling_style":"avg",        #avg / max / cls / attention，padding位置不参与
+    "dynamic_padding": False,     #每个batch截到batch内最长句子的长度
+    "bert_mid_layers": [-2, -1],  #bert_mid_layer截取的层，0为embedding层输出
+    "layer_combine": "sum",       #sum / concat / scalar_mix
+    "truncate_bert": True,        #删掉最深截取层之后的transformer层
+    "bert_num_layers": None,      #bert/bert_lstm/bert_cnn只保留前几层，None为全部保留
+    "distill_epoch": 0,           #保留部分层时，微调前先用完整bert做几轮层蒸馏
+    "teacher_model_type": "bert",  #知识蒸馏的老师模型
+    "teacher_learning_rate": 1e-5,
+    "teacher_weights": "output/teacher.pth",        #老师模型权重，不存在时先训练老师
+    "teacher_logits_path": "output/teacher_logits.npy",  #老师在训练集上的logits缓存
+    "kd_temperature": 2.0,
+    "kd_alpha": 0.5,              #软目标loss的权重，其余为真实标签loss
     "optimizer": "adam",
     "learning_rate": 1e-5,
     "pretrain_model_path":r"E:\pretrain_models\bert-base-chinese",
@@ -19,14 +19,14 @@ class Evaluator:
     def eval(self, epoch):
         self.logger.info("开始测试第%d轮模型效果：" % epoch)
         self.model.eval()
+        device = next(self.model.parameters()).device
         self.stats_dict = {"correct": 0, "wrong": 0}  # 清空上一轮结果
         #输出一下测试集效果
         self.writer = openpyxl.Workbook()
         self.sheet = self.writer.active
         self.sheet.append(["sentence", "true_label", "pred_label", "is_correct"])
         for index, batch_data in enumerate(self.valid_data):
-            if torch.cuda.is_available():
-                batch_data = [d.cuda() for d in batch_data]
+            batch_data = [d.to(device) for d in batch_data]  #输入放到模型所在的设备上，量化模型只能在cpu上运行
             input_ids, labels = batch_data   #输入变化时这里需要修改，比如多输入，多输出的情况
             with torch.no_grad():
                 pred_results = self.model(input_ids) #不输入labels，使用模型当前参数进行预测
@@ -5,7 +5,7 @@ import re
 import os
 import torch
 import numpy as np
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, default_collate
 from transformers import BertTokenizer
 """
 数据加载
@@ -19,7 +19,7 @@ class DataGenerator:
         self.index_to_label = {0: '差评', 1: '好评'}
         self.label_to_index = dict((y, x) for x, y in self.index_to_label.items())
         self.config["class_num"] = len(self.index_to_label)
-        if self.config["model_type"] == "bert":
+        if self.config["model_type"].startswith("bert"):
             self.tokenizer = BertTokenizer.from_pretrained(config["pretrain_model_path"])
         self.vocab = load_vocab(config["vocab_path"])
         self.config["vocab_size"] = len(self.vocab)
@@ -38,8 +38,8 @@ class DataGenerator:
                 else:
                     continue
                 title = line[2:].strip()
-                if self.config["model_type"] == "bert":
-                    input_id = self.tokenizer.encode(title, max_length=self.config["max_length"], pad_to_max_length=True)
+                if self.config["model_type"].startswith("bert"):
+                    input_id = self.tokenizer.encode(title, max_length=self.config["max_length"], padding="max_length", truncation=True)
                 else:
                     input_id = self.encode_sentence(title)
                 self.sentences.append(title)
@@ -76,10 +76,39 @@ def load_vocab(vocab_path):
     return token_dict
 
 
+#在每条样本后面附上老师模型对它的logits，teacher_logits是按样本顺序保存的(样本数, class_num)数组
+#可以是np.memmap，只在取到某条样本时才从磁盘读取
+class SoftTargetDataset(Dataset):
+    def __init__(self, data, teacher_logits):
+        assert len(data) == len(teacher_logits), "老师logits与样本数量不一致"
+        self.data = data
+        self.teacher_logits = teacher_logits
+        self.sentences = data.sentences
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        input_id, label_index = self.data[index]
+        return [input_id, label_index, torch.FloatTensor(np.array(self.teacher_logits[index]))]
+
+
+#动态padding：每个batch只保留到batch内最长句子的长度，后面全是padding的列截掉
+def trim_padding(batch):
+    batch = default_collate(batch)
+    positions = torch.arange(1, batch[0].shape[1] + 1)
+    length = max(int((batch[0].gt(0) * positions).max()), 1)  #最后一个非padding位置
+    batch[0] = batch[0][:, :length]
+    return batch
+
+
 #用torch自带的DataLoader类封装数据
-def load_data(data_path, config, shuffle=True):
+def load_data(data_path, config, shuffle=True, teacher_logits=None):
     dg = DataGenerator(data_path, config)
-    dl = DataLoader(dg, batch_size=config["batch_size"], shuffle=shuffle)
+    if teacher_logits is not None:
+        dg = SoftTargetDataset(dg, teacher_logits)
+    collate_fn = trim_padding if config.get("dynamic_padding") else None
+    dl = DataLoader(dg, batch_size=config["batch_size"], shuffle=shuffle, collate_fn=collate_fn)
     return dl
 
 if __name__ == "__main__":
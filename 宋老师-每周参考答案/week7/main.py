@@ -7,7 +7,7 @@ import os
 import numpy as np
 import logging
 from config import Config
-from model import TorchModel, choose_optimizer
+from model import TorchModel, choose_optimizer, distill_bert_layers, distill_loss
 from evaluate import Evaluator
 from loader import load_data
 #[DEBUG, INFO, WARNING, ERROR, CRITICAL]
@@ -38,6 +38,9 @@ def main(config):
     if cuda_flag:
         logger.info("gpu可以使用，迁移模型至gpu")
         model = model.cuda()
+    #只保留了部分bert层时，微调之前先用完整的bert做层蒸馏
+    if config.get("distill_epoch") and config.get("bert_num_layers") and model.get_bert() is not None:
+        distill_bert_layers(model.get_bert(), config["pretrain_model_path"], train_data, config, logger)
     #加载优化器
     optimizer = choose_optimizer(config, model)
     #加载效果测试类
@@ -66,10 +69,145 @@ def main(config):
         
     # model_path = os.path.join(config["model_path"], "epoch_%d.pth" % epoch)
     # torch.save(model.state_dict(), model_path)  #保存模型权重
+    if config.get("save_path"):
+        torch.save(model.state_dict(), config["save_path"])
     return acc
 
+def teacher_config_of(config):
+    return dict(config, model_type=config["teacher_model_type"], learning_rate=config["teacher_learning_rate"])
+
+#老师在训练集上按样本顺序跑一遍，logits写入磁盘上的.npy文件，之后以memmap方式读取
+#老师权重或训练数据比缓存新时重新生成
+def cache_teacher_logits(config):
+    path = config["teacher_logits_path"]
+    sources = [config["teacher_weights"], config["train_data_path"]]
+    if os.path.exists(path) and os.path.getmtime(path) >= max(os.path.getmtime(p) for p in sources):
+        return np.load(path, mmap_mode="r")
+    teacher_config = teacher_config_of(config)
+    data = load_data(config["train_data_path"], teacher_config, shuffle=False)
+    teacher = TorchModel(teacher_config)
+    teacher.load_state_dict(torch.load(config["teacher_weights"], map_location="cpu"))
+    teacher.eval()
+    if torch.cuda.is_available():
+        teacher = teacher.cuda()
+    logger.info("生成老师logits缓存：%s" % path)
+    logits = np.lib.format.open_memmap(path + ".tmp", mode="w+", dtype=np.float32,
+                                       shape=(len(data.dataset), teacher_config["class_num"]))
+    offset = 0
+    with torch.no_grad():
+        for input_ids, _ in data:
+            if torch.cuda.is_available():
+                input_ids = input_ids.cuda()
+            batch_logits = teacher(input_ids).cpu().numpy()
+            logits[offset:offset + len(batch_logits)] = batch_logits
+            offset += len(batch_logits)
+    logits.flush()
+    del logits
+    os.replace(path + ".tmp", path)
+    return np.load(path, mmap_mode="r")
+
+#知识蒸馏：config["model_type"]为学生模型(如fast_text、cnn)，老师只在生成logits缓存时运行一次
+#学生的loss为 kd_alpha * 软目标loss + (1 - kd_alpha) * 真实标签loss
+def distill(config):
+    if not os.path.isdir(config["model_path"]):
+        os.mkdir(config["model_path"])
+    if not os.path.exists(config["teacher_weights"]):
+        logger.info("没有找到老师模型权重，先训练老师模型")
+        main(dict(teacher_config_of(config), save_path=config["teacher_weights"]))
+    teacher_logits = cache_teacher_logits(config)
+    train_data = load_data(config["train_data_path"], config, teacher_logits=teacher_logits)
+    model = TorchModel(config)
+    cuda_flag = torch.cuda.is_available()
+    if cuda_flag:
+        model = model.cuda()
+    optimizer = choose_optimizer(config, model)
+    evaluator = Evaluator(config, model, logger)
+    for epoch in range(config["epoch"]):
+        epoch += 1
+        model.train()
+        logger.info("蒸馏 epoch %d begin" % epoch)
+        train_loss = []
+        for index, batch_data in enumerate(train_data):
+            if cuda_flag:
+                batch_data = [d.cuda() for d in batch_data]
+            optimizer.zero_grad()
+            input_ids, labels, soft_targets = batch_data
+            loss = distill_loss(model(input_ids), soft_targets, labels, config["kd_temperature"], config["kd_alpha"])
+            loss.backward()
+            optimizer.step()
+            train_loss.append(loss.item())
+        logger.info("epoch average loss: %f" % np.mean(train_loss))
+        acc = evaluator.eval(epoch)
+    if config.get("save_path"):
+        torch.save(model.state_dict(), config["save_path"])
+    return acc
+
+#对比老师和学生在验证集上平均每个batch的推理耗时(cpu)
+def compare_teacher_student(config, max_batch=50):
+    from quantize import measure_latency
+    report = {}
+    for name, model_config in [("老师", teacher_config_of(config)), ("学生", dict(config))]:
+        valid_data = load_data(config["valid_data_path"], model_config, shuffle=False)
+        report[name] = measure_latency(TorchModel(model_config), valid_data, max_batch)
+        logger.info("%s模型 %s：平均每个batch耗时：%f毫秒" % (name, model_config["model_type"], report[name]))
+    logger.info("学生相对老师加速比：%f" % (report["老师"] / report["学生"]))
+    return report
+
+#对比bert_mid_layer不同截取层/合并方式在验证集上的推理耗时、参数量和保留的隐层输出大小(cpu)
+#原来打开output_hidden_states时每个batch保留13层输出，截取后只保留需要的层
+def compare_mid_layer(config, settings, max_batch=50):
+    from quantize import measure_latency, model_size_mb
+    config["model_type"] = "bert_mid_layer"
+    valid_data = load_data(config["valid_data_path"], config, shuffle=False)
+    state_mb = config["batch_size"] * config["max_length"] * 4 / 1024 / 1024  #一层输出的大小 / hidden_size
+    report = []
+    for setting in settings:
+        model = TorchModel(dict(config, **setting)).eval()  #每组设置之间互不影响
+        bert_config = model.encoder.bert.config
+        result = {"setting": setting,
+                  "latency_ms": measure_latency(model, valid_data, max_batch),
+                  "size_mb": model_size_mb(model),
+                  "num_layers": bert_config.num_hidden_layers,
+                  "states_mb": len(model.encoder.tap.layers) * bert_config.hidden_size * state_mb,
+                  "all_states_mb": model.encoder.tap.num_states * bert_config.hidden_size * state_mb}
+        logger.info("%s 保留transformer层数：%d，平均每个batch耗时：%f毫秒，模型大小：%fMB，保留隐层输出：%fMB" %
+                    (setting, result["num_layers"], result["latency_ms"], result["size_mb"], result["states_mb"]))
+        report.append(result)
+    logger.info("output_hidden_states保留全部层输出：%fMB" % report[0]["all_states_mb"])
+    return report
+
+#准确率-耗时曲线：bert只保留前n层分别训练，记录最后一轮准确率和验证集上平均每个batch的推理耗时(cpu)
+#min_acc不为None时，给出满足准确率要求的最少层数
+def depth_curve(config, depths, min_acc=None, max_batch=50):
+    from quantize import measure_latency
+    valid_data = load_data(config["valid_data_path"], config, shuffle=False)
+    report = []
+    for num_layers in depths:
+        depth_config = dict(config, bert_num_layers=num_layers)
+        acc = main(depth_config)
+        latency = measure_latency(TorchModel(depth_config), valid_data, max_batch)  #耗时与权重无关
+        logger.info("bert层数：%d，准确率：%f，平均每个batch耗时：%f毫秒" % (num_layers, acc, latency))
+        report.append({"bert_num_layers": num_layers, "acc": acc, "latency_ms": latency})
+    if min_acc is not None:
+        passed = [result for result in report if result["acc"] >= min_acc]
+        if passed:
+            best = min(passed, key=lambda x: x["latency_ms"])
+            logger.info("准确率不低于%f的最快配置：保留%d层" % (min_acc, best["bert_num_layers"]))
+        else:
+            logger.info("没有层数满足准确率不低于%f" % min_acc)
+    return report
+
 if __name__ == "__main__":
     main(Config)
+    # depth_curve(Config, [2, 4, 6, 8, 12], min_acc=0.88)
+    # Config["model_type"] = "cnn"
+    # Config["learning_rate"] = 1e-3
+    # distill(Config)
+    # compare_teacher_student(Config)
+    # compare_mid_layer(Config, [{"bert_mid_layers": [-2, -1], "truncate_bert": False},
+    #                            {"bert_mid_layers": [-2, -1]},
+    #                            {"bert_mid_layers": [4, 8], "layer_combine": "scalar_mix"},
+    #                            {"bert_mid_layers": [6], "layer_combine": "sum"}])
 
     # for model in ["cnn"]:
     #     Config["model_type"] = model
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import torch
+import numpy as np
 import torch.nn as nn
 from torch.optim import Adam, SGD
 from transformers import BertModel
@@ -36,7 +37,7 @@ class TorchModel(nn.Module):
             self.encoder = RCNN(config)
         elif model_type == "bert":
             self.use_bert = True
-            self.encoder = BertModel.from_pretrained(config["pretrain_model_path"], return_dict=False)
+            self.encoder = load_bert(config)
             hidden_size = self.encoder.config.hidden_size
         elif model_type == "bert_lstm":
             self.use_bert = True
@@ -49,40 +50,65 @@ class TorchModel(nn.Module):
         elif model_type == "bert_mid_layer":
             self.use_bert = True
             self.encoder = BertMidLayer(config)
-            hidden_size = self.encoder.bert.config.hidden_size
+            hidden_size = self.encoder.output_size
 
         self.classify = nn.Linear(hidden_size, class_num)
         self.pooling_style = config["pooling_style"]
+        self.pooling_layer = MaskedPooling(self.pooling_style, hidden_size)
         self.loss = nn.functional.cross_entropy  #loss采用交叉熵损失
 
+    #返回模型中的bert，不使用bert时返回None
+    def get_bert(self):
+        if not self.use_bert:
+            return None
+        return self.encoder if isinstance(self.encoder, BertModel) else self.encoder.bert
+
     #当输入真实标签，返回loss值；无真实标签，返回预测值
     def forward(self, x, target=None):
+        mask = x.gt(0)  #padding位置的id为0，(batch_size, sen_len)
         if self.use_bert:  # bert返回的结果是 (sequence_output, pooler_output)
             #sequence_output:batch_size, max_len, hidden_size
             #pooler_output:batch_size, hidden_size
-            x = self.encoder(x)
+            x = self.encoder(x, mask.long())  #attention_mask，padding位置不参与attention
         else:
             x = self.embedding(x)  # input shape:(batch_size, sen_len)
             x = self.encoder(x)  # input shape:(batch_size, sen_len, input_dim)
 
         if isinstance(x, tuple):  #RNN类的模型会同时返回隐单元向量，我们只取序列结果
             x = x[0]
-        #可以采用pooling的方式得到句向量
-        if self.pooling_style == "max":
-            self.pooling_layer = nn.MaxPool1d(x.shape[1])
-        else:
-            self.pooling_layer = nn.AvgPool1d(x.shape[1])
-        x = self.pooling_layer(x.transpose(1, 2)).squeeze() #input shape:(batch_size, sen_len, input_dim)
+        #可以采用pooling的方式得到句向量，padding位置不参与pooling
+        x = self.pooling_layer(x, mask) #input shape:(batch_size, sen_len, input_dim)
 
         #也可以直接使用序列最后一个位置的向量
         # x = x[:, -1, :]
         predict = self.classify(x)   #input shape:(batch_size, input_dim)
         if target is not None:
-            return self.loss(predict, target.squeeze())
+            return self.loss(predict, target.squeeze(-1))
         else:
             return predict
 
 
+#按padding mask做pooling，输出(batch_size, hidden_size)，与序列长度、padding的多少无关
+#style: avg / max / cls(取第一个位置) / attention(用一个线性层给每个位置打分，softmax后加权求和)
+class MaskedPooling(nn.Module):
+    def __init__(self, style, hidden_size):
+        super(MaskedPooling, self).__init__()
+        self.style = style
+        if style == "attention":
+            self.score = nn.Linear(hidden_size, 1)
+
+    def forward(self, x, mask):  #x:(batch_size, sen_len, hidden_size)  mask:(batch_size, sen_len)
+        if self.style == "cls":
+            return x[:, 0]
+        if self.style == "max":
+            return x.masked_fill(~mask.unsqueeze(-1), torch.finfo(x.dtype).min).max(dim=1)[0]
+        if self.style == "attention":
+            score = self.score(x).squeeze(-1).masked_fill(~mask, torch.finfo(x.dtype).min)
+            return torch.bmm(torch.softmax(score, dim=-1).unsqueeze(1), x).squeeze(1)
+        mask = mask.unsqueeze(-1).to(x.dtype)
+        return (x * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+
+
 class CNN(nn.Module):
     def __init__(self, config):
         super(CNN, self).__init__()
@@ -155,39 +181,134 @@ class RCNN(nn.Module):
         x = self.cnn(x)
         return x
 
+#只保留bert的前num_layers个transformer层，后面的层直接删掉，计算量和参数量随层数线性下降
+def keep_bert_layers(bert, num_layers):
+    if num_layers is not None and num_layers < bert.config.num_hidden_layers:
+        bert.encoder.layer = nn.ModuleList(list(bert.encoder.layer)[:num_layers])
+        bert.config.num_hidden_layers = num_layers
+    return bert
+
+#加载预训练bert，config中bert_num_layers不为None时只保留前bert_num_layers层
+def load_bert(config):
+    bert = BertModel.from_pretrained(config["pretrain_model_path"], return_dict=False)
+    return keep_bert_layers(bert, config.get("bert_num_layers"))
+
+#层蒸馏：以完整的bert为老师，让只保留前几层的bert最后一层的输出拟合完整bert最后一层的输出(MSE)
+#在任务微调之前运行，只用到输入文本，不需要标签
+def distill_bert_layers(student, teacher_path, data, config, logger):
+    device = next(student.parameters()).device
+    teacher = BertModel.from_pretrained(teacher_path, return_dict=False).to(device).eval()
+    for param in teacher.parameters():
+        param.requires_grad = False
+    optimizer = Adam(student.parameters(), lr=config["learning_rate"])
+    for epoch in range(config["distill_epoch"]):
+        student.train()
+        distill_loss = []
+        for batch_data in data:
+            input_ids = batch_data[0].to(device)
+            with torch.no_grad():
+                target = teacher(input_ids)[0]
+            loss = nn.functional.mse_loss(student(input_ids)[0], target)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            distill_loss.append(loss.item())
+        logger.info("层蒸馏第%d轮 平均loss：%f" % (epoch + 1, np.mean(distill_loss)))
+    return student
+
+
 class BertLSTM(nn.Module):
     def __init__(self, config):
         super(BertLSTM, self).__init__()
-        self.bert = BertModel.from_pretrained(config["pretrain_model_path"], return_dict=False)
+        self.bert = load_bert(config)
         self.rnn = nn.LSTM(self.bert.config.hidden_size, self.bert.config.hidden_size, batch_first=True)
 
-    def forward(self, x):
-        x = self.bert(x)[0]
+    def forward(self, x, mask=None):
+        x = self.bert(x, mask)[0]
         x, _ = self.rnn(x)
         return x
 
 class BertCNN(nn.Module):
     def __init__(self, config):
         super(BertCNN, self).__init__()
-        self.bert = BertModel.from_pretrained(config["pretrain_model_path"], return_dict=False)
+        self.bert = load_bert(config)
         config["hidden_size"] = self.bert.config.hidden_size
         self.cnn = CNN(config)
 
-    def forward(self, x):
-        x = self.bert(x)[0]
+    def forward(self, x, mask=None):
+        x = self.bert(x, mask)[0]
+        if mask is not None:
+            x = x * mask.unsqueeze(-1).to(x.dtype)  #padding位置置0，与CNN边界的补0一致
         x = self.cnn(x)
         return x
 
+#通过forward hook只截取需要的层，不再打开output_hidden_states保存全部13层的输出
+#层编号与hidden_states一致：0为embedding层输出，i为第i个transformer层输出，负数从最后一层往前数
+#truncate_bert为True时，删掉最深的被截取层之后的transformer层，这些层的计算和参数都省掉了
+#不是nn.Module，bert仍然只注册在使用它的模型上，保存的权重名不变
+class BertLayerTap:
+    def __init__(self, bert, layers, truncate=True):
+        self.bert = bert
+        self.num_states = bert.config.num_hidden_layers + 1  #截断前的层数，包括embedding层
+        self.layers = [layer % self.num_states for layer in layers]
+        if truncate:
+            keep_bert_layers(self.bert, max(self.layers))
+
+    #hook只在一次前向中注册，结束后删除，不在bert上留下引用这个对象的闭包
+    #这样copy.deepcopy(模型)(如量化时)得到的副本不会把输出写到原模型的tap里
+    #返回截取到的各层输出，顺序与layers一致
+    def __call__(self, x, mask=None):
+        states = {}
+        def make_hook(layer):
+            def hook(module, inputs, output):
+                states[layer] = output[0] if isinstance(output, tuple) else output
+            return hook
+        handles = []
+        for layer in set(self.layers):
+            module = self.bert.embeddings if layer == 0 else self.bert.encoder.layer[layer - 1]
+            handles.append(module.register_forward_hook(make_hook(layer)))
+        try:
+            self.bert(x, mask)
+        finally:
+            for handle in handles:
+                handle.remove()
+        return [states[layer] for layer in self.layers]
+
+
 class BertMidLayer(nn.Module):
     def __init__(self, config):
         super(BertMidLayer, self).__init__()
-        self.bert = BertModel.from_pretrained(config["pretrain_model_path"], return_dict=False)
-        self.bert.config.output_hidden_states = True
+        bert = BertModel.from_pretrained(config["pretrain_model_path"], return_dict=False)
+        layers = config.get("bert_mid_layers", [-2, -1])
+        self.tap = BertLayerTap(bert, layers, config.get("truncate_bert", True))
+        self.bert = self.tap.bert
+        self.combine = config.get("layer_combine", "sum")  #sum / concat / scalar_mix
+        self.output_size = self.bert.config.hidden_size
+        if self.combine == "concat":
+            self.output_size = self.bert.config.hidden_size * len(layers)
+        elif self.combine == "scalar_mix":
+            #ELMo的做法：各层权重softmax归一化后加权求和，再乘一个整体缩放系数
+            self.layer_weights = nn.Parameter(torch.zeros(len(layers)))
+            self.gamma = nn.Parameter(torch.ones(1))
 
-    def forward(self, x):
-        layer_states = self.bert(x)[2]#(13, batch, len, hidden)
-        layer_states = torch.add(layer_states[-2], layer_states[-1])
-        return layer_states
+    def forward(self, x, mask=None):
+        layer_states = self.tap(x, mask)  #len(layers) * (batch, len, hidden)
+        if self.combine == "concat":
+            return torch.cat(layer_states, dim=-1)
+        elif self.combine == "scalar_mix":
+            weights = torch.softmax(self.layer_weights, dim=0)
+            return self.gamma * sum(w * state for w, state in zip(weights, layer_states))
+        return sum(layer_states[1:], layer_states[0])
+
+
+#知识蒸馏的loss：老师logits经温度平滑后作为软目标，与学生输出求KL散度，再加上真实标签的交叉熵
+#KL项乘temperature^2，使它的梯度量级不随温度变化
+def distill_loss(student_logits, teacher_logits, target, temperature=2.0, alpha=0.5):
+    soft_loss = nn.functional.kl_div(nn.functional.log_softmax(student_logits / temperature, dim=-1),
+                                     nn.functional.softmax(teacher_logits / temperature, dim=-1),
+                                     reduction="batchmean") * temperature ** 2
+    hard_loss = nn.functional.cross_entropy(student_logits, target.squeeze(-1))
+    return alpha * soft_loss + (1 - alpha) * hard_loss
 
 
 #优化器的选择
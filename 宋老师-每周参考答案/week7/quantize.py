@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import copy
+import time
+import torch
+import torch.nn as nn
+from torch.quantization import quantize_dynamic, default_dynamic_qconfig
+
+"""
+bert类模型的CPU动态int8量化导出
+只量化nn.Linear层：权重离线转为int8，激活在推理时动态量化，不需要校准数据
+week7的TorchModel、week9/week13的NER模型、week10/week11的LanguageModel都可以直接使用，
+语言模型的classify是21128×768的大矩阵，可以通过quantize_classify选择是否一起量化
+注意：量化后的模型只能在cpu上运行，compare会把fp32模型也放到cpu上，Evaluator按模型所在设备放置输入
+"""
+
+
+#返回量化后的新模型，原模型不变
+#classify层直接决定输出，量化误差对结果影响最大，默认保持fp32
+def quantize_model(model, quantize_classify=False, classify_name="classify"):
+    model = copy.deepcopy(model).cpu().eval()
+    qconfig_spec = {}
+    for name, module in model.named_modules():
+        if not isinstance(module, nn.Linear):
+            continue
+        if name.split(".")[-1] == classify_name and not quantize_classify:
+            continue
+        qconfig_spec[name] = default_dynamic_qconfig
+    return quantize_dynamic(model, qconfig_spec, dtype=torch.qint8)
+
+#序列化后的权重大小，单位MB
+def model_size_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 1024 / 1024
+
+#在验证集上测量平均每个batch的推理耗时，单位毫秒
+def measure_latency(model, data, max_batch=50):
+    model.eval()
+    cost = []
+    with torch.no_grad():
+        for index, batch_data in enumerate(data):
+            if index >= max_batch:
+                break
+            input_ids = batch_data[0]
+            start_time = time.time()
+            model(input_ids)
+            cost.append(time.time() - start_time)
+    return sum(cost) / max(len(cost), 1) * 1000
+
+#对比量化前后的效果、耗时和模型大小
+#evaluator需要返回评价指标，week7返回准确率，week9/week13返回Micro-F1
+def compare(model, evaluator, quantize_classify=False):
+    fp32_model = model.cpu().eval()
+    int8_model = quantize_model(fp32_model, quantize_classify)
+    report = {}
+    for name, m in [("fp32", fp32_model), ("int8", int8_model)]:
+        evaluator.model = m
+        evaluator.logger.info("开始测试%s模型" % name)
+        report[name] = {"metric": evaluator.eval(0),
+                        "latency_ms": measure_latency(m, evaluator.valid_data),
+                        "size_mb": model_size_mb(m)}
+    evaluator.model = fp32_model
+    for name, result in report.items():
+        evaluator.logger.info("%s模型 指标：%f，平均每个batch耗时：%f毫秒，模型大小：%fMB" %
+                              (name, result["metric"], result["latency_ms"], result["size_mb"]))
+    evaluator.logger.info("量化后指标变化：%f，加速比：%f，模型大小压缩比：%f" % (
+        report["int8"]["metric"] - report["fp32"]["metric"],
+        report["fp32"]["latency_ms"] / report["int8"]["latency_ms"],
+        report["fp32"]["size_mb"] / report["int8"]["size_mb"]))
+    return int8_model, report
+
+#保存量化后的权重
+def export(int8_model, path):
+    torch.save(int8_model.state_dict(), path)
+
+#加载量化权重：先用同样的方式量化一个未训练的模型，使结构一致后再加载
+def load_quantized(model, path, quantize_classify=False):
+    int8_model = quantize_model(model, quantize_classify)
+    int8_model.load_state_dict(torch.load(path))
+    return int8_model
+
+#检查bert_mid_layer模型深拷贝、量化后仍能正常前向：
+#副本与原模型输出一致，量化模型输出形状一致，且原模型不受影响
+def check_quantize_mid_layer(config, batch_size=2):
+    from model import TorchModel
+    config = dict(config, model_type="bert_mid_layer", class_num=2, vocab_size=config.get("vocab_size", 4622))
+    model = TorchModel(config).eval()
+    x = torch.randint(1, 4000, (batch_size, config["max_length"]))
+    with torch.no_grad():
+        output = model(x)
+        copied = copy.deepcopy(model).eval()
+        assert torch.allclose(copied(x), output)
+        int8_model = quantize_model(model)
+        assert int8_model(x).shape == output.shape
+        assert torch.allclose(model(x), output)
+    print("bert_mid_layer深拷贝和量化检查通过")
+
+
+if __name__ == "__main__":
+    import sys
+    import logging
+    from config import Config
+    from model import TorchModel
+    from evaluate import Evaluator
+    if len(sys.argv) > 1 and sys.argv[1] == "check":
+        check_quantize_mid_layer(Config)
+        sys.exit()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger = logging.getLogger(__name__)
+
+    evaluator = Evaluator(Config, None, logger)  #加载验证集时会写入class_num和vocab_size
+    model = TorchModel(Config)
+    model.load_state_dict(torch.load(os.path.join(Config["model_path"], "epoch_%d.pth" % Config["epoch"]), map_location="cpu"))
+    int8_model, report = compare(model, evaluator)
+    export(int8_model, os.path.join(Config["model_path"], "epoch_%d_int8.pth" % Config["epoch"]))
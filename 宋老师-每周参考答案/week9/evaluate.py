@@ -24,16 +24,16 @@ class Evaluator:
                            "PERSON": defaultdict(int),
                            "ORGANIZATION": defaultdict(int)}
         self.model.eval()
+        device = next(self.model.parameters()).device
         for index, batch_data in enumerate(self.valid_data):
             sentences = self.valid_data.dataset.sentences[index * self.config["batch_size"]: (index+1) * self.config["batch_size"]]
-            if torch.cuda.is_available():
-                batch_data = [d.cuda() for d in batch_data]
+            batch_data = [d.to(device) for d in batch_data]  #输入放到模型所在的设备上，量化模型只能在cpu上运行
             input_id, labels = batch_data   #输入变化时这里需要修改，比如多输入，多输出的情况
             with torch.no_grad():
                 pred_results = self.model(input_id) #不输入labels，使用模型当前参数进行预测
             self.write_stats(labels, pred_results, sentences)
-        self.show_stats()
-        return
+        micro_f1 = self.show_stats()
+        return micro_f1
 
     def write_stats(self, labels, pred_results, sentences):
         assert len(labels) == len(pred_results) == len(sentences)
@@ -72,7 +72,7 @@ class Evaluator:
         micro_f1 = (2 * micro_precision * micro_recall) / (micro_precision + micro_recall + 1e-5)
         self.logger.info("Micro-F1 %f" % micro_f1)
         self.logger.info("--------------------")
-        return
+        return micro_f1
 
     '''
     {
@@ -3,21 +3,291 @@ import json
 import pandas as pd
 from py2neo import Graph
 from collections import defaultdict
+import io
+import time
+import contextlib
+import queue
+import threading
 import itertools
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AhoCorasick:
+    """
+    多模式串匹配自动机，构建一次后对句子做一次线性扫描即可找出所有词表中的词
+    """
+    def __init__(self, words):
+        self.goto = [{}]      # 每个状态的转移表
+        self.fail = [0]       # 失配指针
+        self.output = [[]]    # 到达该状态时结束的词（包含沿失配指针可达的后缀词）
+        self.words = []
+        for word in words:
+            self.add_word(word)
+        self.build()
+
+    def add_word(self, word):
+        if not word:
+            return
+        state = 0
+        for char in word:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        if not self.output[state]:
+            self.output[state].append(len(self.words))
+            self.words.append(word)
+
+    def build(self):
+        """按层次遍历构建失配指针，并把后缀状态的输出合并进来"""
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def iter_matches(self, text):
+        """返回所有（可能重叠的）匹配 (start, end, word)"""
+        state = 0
+        for end, char in enumerate(text, 1):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for word_id in self.output[state]:
+                word = self.words[word_id]
+                yield end - len(word), end, word
+
+
+class CypherCache:
+    """Cypher 查询结果缓存：LRU + 过期淘汰，key 为规范化后的 Cypher 语句"""
+    def __init__(self, max_size=1024, ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl  # 秒，图谱更新后最多这么久缓存失效
+        self.items = OrderedDict()  # key = Cypher， value = [写入时间, 查询结果]
+        self.lock = threading.Lock()  # 候选 Cypher 在线程池中并发执行
+
+    @staticmethod
+    def normalize(cypher):
+        return " ".join(cypher.split())
+
+    def get(self, cypher):
+        key = self.normalize(cypher)
+        with self.lock:
+            if key not in self.items:
+                return None
+            save_time, result = self.items[key]
+            if time.time() - save_time >= self.ttl:
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return result
+
+    def put(self, cypher, result):
+        with self.lock:
+            self.items[self.normalize(cypher)] = [time.time(), result]
+            self.items.move_to_end(self.normalize(cypher))
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+class Neo4jBackend:
+    """
+    Neo4j 后端：维护一个 py2neo.Graph 连接池，每个线程执行时取出一个连接，用完放回
+    """
+    def __init__(self, uri="http://localhost:7474", user="neo4j", password="881201", pool_size=4, timeout=30):
+        self.uri = uri
+        self.auth = (user, password)
+        self.pool = queue.Queue()
+        self.pool_size = pool_size
+        self.timeout = timeout  # 等待空闲连接的最长秒数
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # 锁内只占用名额，建立连接放在锁外，慢的连接不会阻塞其他线程
+        with self.lock:
+            reserve = self.pool.empty() and self.created < self.pool_size
+            if reserve:
+                self.created += 1
+        if reserve:
+            try:
+                return Graph(self.uri, auth=self.auth)
+            except Exception:
+                # 连接失败时归还名额，否则名额耗尽后所有调用都会一直等待
+                with self.lock:
+                    self.created -= 1
+                raise
+        try:
+            return self.pool.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError("等待Neo4j连接超时(%s秒)" % self.timeout)
+
+    def run(self, cypher):
+        graph = self.acquire()
+        try:
+            result = graph.run(cypher).data()
+        except Exception:
+            # 出错的连接可能已经断开，丢弃并归还名额，之后按需重新建立
+            with self.lock:
+                self.created -= 1
+            raise
+        self.pool.put(graph)
+        return result
+
+
+def clean_name(x):
+    """与 build_graph.py 一致：去掉实体名中的（...）说明"""
+    return re.sub(r"（.+）", "", x).strip()
+
+
+class TripleStoreBackend:
+    """
+    进程内三元组存储，不需要启动 Neo4j 即可运行整个问答流程
+    支持问答模板中用到的单跳查询：
+        MATCH (m {NAME:"x"}) RETURN m.属性 AS result
+        MATCH (p {NAME:"x"})-[:关系]->(n) RETURN n.NAME / collect(n.NAME) AS result
+        MATCH (n)-[:关系]->(s {NAME:"x"}) RETURN n.NAME AS result
+        MATCH (a {NAME:"x"})-[r]-(b {NAME:"y"}) RETURN type(r) AS result
+    返回值与 py2neo 的 .data() 格式相同
+    """
+    NODE = r"\(\s*(\w*)\s*(?::\s*`?([^`{}\s)]+)`?)?\s*(?:\{\s*NAME\s*:\s*[\"']([^\"']*)[\"']\s*\})?\s*\)"
+    PATTERN = re.compile(r"^MATCH\s+" + NODE +
+                         r"(?:\s*(<)?-\s*\[\s*(\w*)\s*(?::\s*`?([^`\]]+?)`?)?\s*\]\s*-(>)?\s*" + NODE + ")?"
+                         r"\s+RETURN\s+(.+?)(?:\s+AS\s+(\w+))?\s*$", re.IGNORECASE | re.DOTALL)
+
+    def __init__(self):
+        self.nodes = set()
+        self.labels = {}  # key = 实体， value = 标签，没有标签的实体为 Entity
+        self.attributes = defaultdict(dict)
+        self.out_edges = defaultdict(list)  # key = 头实体， value = [(关系, 尾实体)]
+        self.in_edges = defaultdict(list)   # key = 尾实体， value = [(关系, 头实体)]
+
+    @classmethod
+    def from_files(cls, relation_path="triplets_head_rel_tail.txt", attribute_path="triplets_enti_attr_value.txt",
+                   all_triplets_path=None):
+        """
+        从三元组文件构建；all_triplets.txt 这类不区分关系和属性的文件，
+        每条三元组同时作为关系和属性加入，两种查询都能命中
+        """
+        store = cls()
+        for path, as_relation, as_attribute in [(relation_path, True, False), (attribute_path, False, True),
+                                                (all_triplets_path, True, True)]:
+            if path is None:
+                continue
+            with open(path, encoding="utf8") as f:
+                for line in f:
+                    parts = line.strip().split("\t")
+                    if len(parts) != 3:
+                        continue
+                    head, rel, tail = parts
+                    if as_relation:
+                        store.add_relation(head, rel, tail)
+                    if as_attribute:
+                        store.add_attribute(head, rel, tail)
+        return store
+
+    def add_node(self, raw_name):
+        name = clean_name(raw_name)
+        self.nodes.add(name)
+        for label in ["歌曲", "专辑", "电影", "电视剧", "综艺"]:
+            if name != raw_name and label in raw_name[len(name):]:
+                self.labels[name] = label
+                break
+        return name
+
+    def add_relation(self, head, rel, tail):
+        head, tail = self.add_node(head), self.add_node(tail)
+        self.out_edges[head].append((rel, tail))
+        self.in_edges[tail].append((rel, head))
+
+    def add_attribute(self, entity, attr, value):
+        entity = self.add_node(entity)
+        self.attributes[entity].setdefault(attr, value)
+
+    def match_nodes(self, label, name):
+        names = [name] if name is not None else self.nodes
+        return [n for n in names if n in self.nodes and (not label or self.labels.get(n, "Entity") == label)]
+
+    def match_rows(self, match):
+        (left_var, left_label, left_name, left_arrow, rel_var, rel_type, right_arrow,
+         right_var, right_label, right_name) = match.groups()[:10]
+        if right_var is None and right_label is None and right_name is None and rel_type is None \
+                and rel_var is None:
+            return [{left_var: n} for n in self.match_nodes(left_label, left_name)]
+        rows = []
+        right_nodes = set(self.match_nodes(right_label, right_name))
+        for left in self.match_nodes(left_label, left_name):
+            edges = []
+            if not left_arrow:
+                edges += self.out_edges.get(left, [])
+            if not right_arrow:
+                edges += self.in_edges.get(left, [])
+            for rel, right in edges:
+                if (rel_type is None or rel == rel_type) and right in right_nodes:
+                    rows.append({left_var: left, rel_var: rel, right_var: right})
+        return rows
+
+    def evaluate(self, expression, row):
+        expression = expression.strip()
+        if expression.lower().startswith("type(") and expression.endswith(")"):
+            return row.get(expression[5:-1].strip())
+        var, _, prop = expression.partition(".")
+        name = row.get(var.strip())
+        if name is None or not prop:
+            return name
+        if prop.strip() == "NAME":
+            return name
+        return self.attributes.get(name, {}).get(prop.strip())
+
+    def run(self, cypher):
+        match = self.PATTERN.match(cypher.strip())
+        if match is None:
+            raise ValueError(f"三元组后端不支持的 Cypher：{cypher}")
+        expression, alias = match.group(11), match.group(12)
+        alias = alias or expression.strip()
+        rows = self.match_rows(match)
+        if expression.strip().lower().startswith("collect(") and expression.strip().endswith(")"):
+            inner = expression.strip()[8:-1]
+            values = [self.evaluate(inner, row) for row in rows]
+            return [{alias: [v for v in values if v is not None]}]
+        return [{alias: self.evaluate(expression, row)} for row in rows]
 
 
 class GraphQA:
     def __init__(self, uri="http://localhost:7474", user="neo4j", password="881201",
-                 schema_path="kg_schema.json", templet_path="question_templet_fixed.xlsx"):
+                 schema_path="kg_schema.json", templet_path="question_templet_fixed.xlsx",
+                 mention_longest=True, mention_overlap=False,
+                 backend=None, pool_size=4, top_k=3, cache_size=1024, cache_ttl=600):
         """
         初始化问答系统
+        mention_longest: 同一位置有多个词时优先取最长的，否则取最短的
+        mention_overlap: 是否保留互相重叠的提及
+        backend: 执行 Cypher 的后端，需要提供 run(cypher) 方法，默认连接 Neo4j
+        top_k: 并发执行得分最高的前 k 个候选 Cypher，按得分顺序取第一个有结果的
         """
-        self.graph = Graph(uri, auth=(user, password))
+        self.backend = backend if backend is not None else Neo4jBackend(uri, user, password, pool_size)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+        self.cypher_cache = CypherCache(cache_size, cache_ttl)
+        self.top_k = top_k
         self.entity_set = set()
         self.relation_set = set()
         self.attribute_set = set()
         self.label_set = set()
         self.question_templates = []
+        self.mention_longest = mention_longest
+        self.mention_overlap = mention_overlap
 
         # 加载 schema 和模板
         self.load_schema(schema_path)
@@ -32,6 +302,13 @@ class GraphQA:
         self.relation_set = set(schema.get("relations", []))
         self.attribute_set = set(schema.get("attributes", []))
         self.label_set = set(schema.get("labels", []))
+        # 所有词放进一个自动机，记录每个词属于哪些类型（同一个词可能既是实体又是属性）
+        self.mention_types = defaultdict(list)
+        for slot, words in [("%ENT%", self.entity_set), ("%REL%", self.relation_set),
+                            ("%ATT%", self.attribute_set), ("%LAB%", self.label_set)]:
+            for word in words:
+                self.mention_types[word].append(slot)
+        self.mention_automaton = AhoCorasick(sorted(self.mention_types))
 
     def load_question_templet(self, templet_path):
         """从 Excel 加载问答模板"""
@@ -52,17 +329,55 @@ class GraphQA:
         except Exception as e:
             print(f"❌ 加载模板失败：{e}")
             self.question_templates = []
+        self.build_template_index()
+
+    def template_keys(self, template_slots):
+        """模板中会被替换的占位符，与 generate_combinations 生成的 mapping 的 key 一致"""
+        keys = []
+        for slot, required_count in template_slots.items():
+            if required_count == 1:
+                keys.append(slot)
+            else:
+                keys += [f"{slot[:-1]}{i+1}%" for i in range(required_count)]
+        return keys
+
+    def build_template_index(self):
+        """
+        按槽位需求(cypher_check)对模板分组，同一组只需要检查一次槽位是否满足
+        同时预先去掉问题模板中的占位符，剩下的固定文字用于计算相似度
+        """
+        self.template_index = defaultdict(list)
+        for order, (question, cypher, cypher_check, answer) in enumerate(self.question_templates):
+            keys = self.template_keys(cypher_check)
+            static_text = question
+            for key in sorted(keys, key=len, reverse=True):
+                static_text = static_text.replace(key, "")
+            signature = tuple(sorted(cypher_check.items()))
+            self.template_index[signature].append((order, set(static_text), cypher_check))
+
+    def find_mentions(self, sentence, longest=None, overlap=None):
+        """
+        一次扫描找出句子中的实体、关系、属性、标签提及
+        返回 {类型: [(start, end, word), ...]}，每种类型内部按位置排序
+        不保留重叠时，每种类型各自从左到右选择互不重叠的提及，不同类型之间互不影响
+        """
+        longest = self.mention_longest if longest is None else longest
+        overlap = self.mention_overlap if overlap is None else overlap
+        matches = sorted(self.mention_automaton.iter_matches(sentence),
+                         key=lambda m: (m[0], -m[1] if longest else m[1]))
+        mentions = {"%ENT%": [], "%REL%": [], "%ATT%": [], "%LAB%": []}
+        for start, end, word in matches:
+            for slot in self.mention_types[word]:
+                if overlap or not mentions[slot] or mentions[slot][-1][1] <= start:
+                    mentions[slot].append((start, end, word))
+        return mentions
 
     def extract_mentions(self, sentence):
-        """提取句子中提到的实体、关系、属性"""
-        entities = list(set(re.findall("|".join(re.escape(e) for e in self.entity_set), sentence)))
-        relations = list(set(re.findall("|".join(re.escape(r) for r in self.relation_set), sentence)))
-        attributes = list(set(re.findall("|".join(re.escape(a) for a in self.attribute_set), sentence)))
-        return {
-            "%ENT%": entities,
-            "%REL%": relations,
-            "%ATT%": attributes
-        }
+        """提取句子中提到的实体、关系、属性、标签"""
+        info = {}
+        for slot, mentions in self.find_mentions(sentence).items():
+            info[slot] = list(dict.fromkeys(word for _, _, word in mentions))
+        return info
 
     def is_slot_valid(self, info, template_slots):
         """检查信息是否满足模板需求"""
@@ -97,10 +412,22 @@ class GraphQA:
             filled = filled.replace(k, v)
         return filled
 
+    def run_cypher(self, cypher):
+        """执行 Cypher 并返回原始结果，结果按规范化后的语句缓存"""
+        result = self.cypher_cache.get(cypher)
+        if result is None:
+            result = self.backend.run(cypher)
+            self.cypher_cache.put(cypher, result)
+        return result
+
+    def execute_cyphers(self, cyphers):
+        """在线程池中并发执行多个 Cypher，按输入顺序返回结果字符串"""
+        return list(self.executor.map(self.execute_cypher, cyphers))
+
     def execute_cypher(self, cypher):
         """执行 Cypher 并返回结果字符串"""
         try:
-            result = self.graph.run(cypher).data()
+            result = self.run_cypher(cypher)
             if not result or not result[0]:
                 return None
             # 尝试提取多种可能的返回字段
@@ -123,12 +450,71 @@ class GraphQA:
             print("❌ Cypher 执行错误：", e)
             return None
 
-    def query(self, question):
-        print(f"\n🔍 问题：{question}")
-        info = self.extract_mentions(question)
+    def match_template(self, question, info, threshold=0.6):
+        """找出与问题最相似的填充模板，没有超过阈值的返回 None"""
+        matches = self.match_templates(question, info, 1, threshold)
+        return matches[0] if matches else None
+
+    def match_templates(self, question, info, top_k=1, threshold=0.6):
+        """
+        按相似度从高到低返回前 top_k 个填充模板，第一个与逐个展开打分（match_template_naive）的结果完全一致
+        提及的词都是问题的子串，填充后问题的字集合 = 模板固定文字 ∪ 填入的词，
+        所以 Jaccard 的并集大小只和模板有关，交集只需要统计填入的词带来多少模板里没有的字。
+        把问题中的每个字编号，词表示成位掩码，一个组合的得分只需要一次按位或和计数。
+        每个模板先用所有候选词算出得分上界，按上界从高到低处理，上界不超过当前最优时直接跳过，
+        只有最终胜出的组合才真正填充文本。
+        """
+        question_chars = set(question)
+        char_bit = dict((char, 1 << i) for i, char in enumerate(question_chars))
+        value_mask = {}
+        for values in info.values():
+            for value in values:
+                value_mask[value] = sum(char_bit[char] for char in set(value))
+
+        candidates = []
+        for signature, templates in self.template_index.items():
+            if not self.is_slot_valid(info, dict(signature)):
+                continue
+            all_values_mask = 0
+            for slot, _ in signature:
+                for value in info.get(slot, []):
+                    all_values_mask |= value_mask[value]
+            for order, static_chars, cypher_check in templates:
+                static_mask = sum(char_bit[char] for char in static_chars & question_chars)
+                base = bin(static_mask).count("1")
+                union = len(question_chars | static_chars) + 1e-8
+                upper_bound = (base + bin(all_values_mask & ~static_mask).count("1")) / union
+                candidates.append((upper_bound, order, static_mask, base, union, cypher_check))
+        candidates.sort(key=lambda x: (-x[0], x[1]))
+
+        # 排序key：(-得分, 模板序号, 组合序号)，得分相同时保留原始顺序中靠前的
+        best = []
+        for upper_bound, order, static_mask, base, union, cypher_check in candidates:
+            if upper_bound <= threshold or (len(best) == top_k and upper_bound < -best[-1][0][0]):
+                break
+            for index, mapping in enumerate(self.generate_combinations(info, cypher_check)):
+                mask = 0
+                for value in mapping.values():
+                    mask |= value_mask[value]
+                score = (base + bin(mask & ~static_mask).count("1")) / union
+                key = (-score, order, index)
+                if score > threshold and (len(best) < top_k or key < best[-1][0]):
+                    best.append((key, mapping))
+                    best.sort(key=lambda x: x[0])
+                    del best[top_k:]
 
+        matches = []
+        for (_, order, _), mapping in best:
+            template_question, cypher, _, answer = self.question_templates[order]
+            matches.append((self.fill_template(template_question, mapping),
+                            self.fill_template(cypher, mapping),
+                            self.fill_template(answer, mapping)))
+        return matches
+
+    def match_template_naive(self, question, info, threshold=0.6):
+        """逐个模板展开所有组合、填充文本后打分，作为对照"""
         best_match = None
-        best_score = 0.6  # 阈值
+        best_score = threshold
 
         for template in self.question_templates:
             template_question, cypher, cypher_check, answer = template
@@ -145,12 +531,45 @@ class GraphQA:
                 if score > best_score:
                     best_score = score
                     best_match = (filled_question, filled_cypher, filled_answer)
+        return best_match
+
+    def benchmark_matching(self, questions, repeat=100):
+        """对比两种模板匹配方式的平均耗时，并检查结果是否一致"""
+        infos = [self.extract_mentions(question) for question in questions]
+        for question, info in zip(questions, infos):
+            assert self.match_template(question, info) == self.match_template_naive(question, info), question
+        for name, match in [("逐个展开", self.match_template_naive), ("索引+剪枝", self.match_template)]:
+            start_time = time.time()
+            for _ in range(repeat):
+                for question, info in zip(questions, infos):
+                    match(question, info)
+            cost_time = (time.time() - start_time) / (repeat * len(questions))
+            print(f"⏱️ {name}：平均每个问题 {cost_time * 1000:.4f} 毫秒")
+
+    def benchmark_query(self, questions, repeat=10):
+        """完整问答流程的平均耗时：清空缓存后的第一轮，以及命中缓存的后续轮次"""
+        self.cypher_cache.clear()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start_time = time.time()
+            for question in questions:
+                self.query(question)
+            cold_time = (time.time() - start_time) / len(questions)
+            start_time = time.time()
+            for _ in range(repeat):
+                for question in questions:
+                    self.query(question)
+            warm_time = (time.time() - start_time) / (repeat * len(questions))
+        print(f"⏱️ 问答平均耗时：无缓存 {cold_time * 1000:.4f} 毫秒，命中缓存 {warm_time * 1000:.4f} 毫秒")
+
+    def query(self, question):
+        print(f"\n🔍 问题：{question}")
+        info = self.extract_mentions(question)
+        matches = self.match_templates(question, info, self.top_k)
+        answer_values = self.execute_cyphers([filled_cypher for _, filled_cypher, _ in matches])
 
-        if best_match:
-            filled_question, filled_cypher, filled_answer = best_match
+        for (filled_question, filled_cypher, filled_answer), answer_value in zip(matches, answer_values):
             print(f"🎯 匹配模板：{filled_question}")
             print(f"🧩 Cypher：{filled_cypher}")
-            answer_value = self.execute_cypher(filled_cypher)
             if answer_value:
                 # ✅ 修复：尝试多种可能的 result 格式
                 possible_patterns = [
@@ -184,7 +603,12 @@ class GraphQA:
 # 使用示例
 # ========================
 if __name__ == "__main__":
-    qa = GraphQA()
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "local":
+        # 不连接 Neo4j，直接用三元组文件构建进程内存储
+        qa = GraphQA(backend=TripleStoreBackend.from_files())
+    else:
+        qa = GraphQA()
 
     # 测试问题
     questions = [
@@ -205,6 +629,9 @@ if __name__ == "__main__":
     for q in questions:
         qa.query(q)
 
+    qa.benchmark_matching(questions)
+    qa.benchmark_query(questions)
+
 # import pandas as pd
 # import re
 # import json
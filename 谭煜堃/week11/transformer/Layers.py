@@ -33,10 +33,12 @@ class DecoderLayer(nn.Module):
 
     def forward(
             self, dec_input, enc_output,
-            slf_attn_mask=None, dec_enc_attn_mask=None):
+            slf_attn_mask=None, dec_enc_attn_mask=None,
+            slf_attn_cache=None, enc_attn_cache=None):
         dec_output, dec_slf_attn = self.slf_attn(
-            dec_input, dec_input, dec_input, mask=slf_attn_mask)
+            dec_input, dec_input, dec_input, mask=slf_attn_mask, cache=slf_attn_cache)
         dec_output, dec_enc_attn = self.enc_attn(
-            dec_output, enc_output, enc_output, mask=dec_enc_attn_mask)
+            dec_output, enc_output, enc_output, mask=dec_enc_attn_mask,
+            cache=enc_attn_cache, static_kv=True)
         dec_output = self.pos_ffn(dec_output)
         return dec_output, dec_slf_attn, dec_enc_attn
@@ -124,6 +124,27 @@ class Decoder(nn.Module):
             return dec_output, dec_slf_attn_list, dec_enc_attn_list
         return dec_output,
 
+    def init_cache(self):
+        ''' One (self-attention, enc-dec attention) key/value cache per layer. '''
+        return [({}, {}) for _ in self.layer_stack]
+
+    def forward_step(self, trg_step, step, enc_output, src_mask, cache):
+        ''' Decode only the newest position, reusing the keys/values of earlier steps from cache. '''
+
+        # -- Forward
+        dec_output = self.trg_word_emb(trg_step)
+        if self.scale_emb:
+            dec_output *= self.d_model ** 0.5
+        dec_output = dec_output + self.position_enc.pos_table[:, step:step + 1].clone().detach()
+        dec_output = self.dropout(dec_output)
+        dec_output = self.layer_norm(dec_output)
+
+        for dec_layer, (slf_attn_cache, enc_attn_cache) in zip(self.layer_stack, cache):
+            dec_output, _, _ = dec_layer(
+                dec_output, enc_output, dec_enc_attn_mask=src_mask,
+                slf_attn_cache=slf_attn_cache, enc_attn_cache=enc_attn_cache)
+        return dec_output
+
 
 class Transformer(nn.Module):
     ''' A sequence to sequence model with attention mechanism. '''
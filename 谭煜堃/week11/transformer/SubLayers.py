@@ -1,5 +1,6 @@
 ''' Define the sublayers in encoder/decoder layer '''
 import numpy as np
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from transformer.Modules import ScaledDotProductAttention
@@ -27,7 +28,12 @@ class MultiHeadAttention(nn.Module):
         self.layer_norm = nn.LayerNorm(d_model, eps=1e-6)
 
 
-    def forward(self, q, k, v, mask=None):
+    def forward(self, q, k, v, mask=None, cache=None, static_kv=False):
+        '''
+        cache: optional dict holding projected keys/values across decoding steps.
+        static_kv: keys/values (e.g. encoder output) do not change between steps,
+                   so they are projected once and reused from the cache.
+        '''
 
         d_k, d_v, n_head = self.d_k, self.d_v, self.n_head
         sz_b, len_q, len_k, len_v = q.size(0), q.size(1), k.size(1), v.size(1)
@@ -36,12 +42,19 @@ class MultiHeadAttention(nn.Module):
 
         # Pass through the pre-attention projection: b x lq x (n*dv)
         # Separate different heads: b x lq x n x dv
-        q = self.w_qs(q).view(sz_b, len_q, n_head, d_k)
-        k = self.w_ks(k).view(sz_b, len_k, n_head, d_k)
-        v = self.w_vs(v).view(sz_b, len_v, n_head, d_v)
-
         # Transpose for attention dot product: b x n x lq x dv
-        q, k, v = q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)
+        q = self.w_qs(q).view(sz_b, len_q, n_head, d_k).transpose(1, 2)
+        if cache is not None and static_kv and 'k' in cache:
+            k, v = cache['k'], cache['v']
+        else:
+            k = self.w_ks(k).view(sz_b, len_k, n_head, d_k).transpose(1, 2)
+            v = self.w_vs(v).view(sz_b, len_v, n_head, d_v).transpose(1, 2)
+            if cache is not None:
+                if not static_kv and 'k' in cache:
+                    # -- append the newest positions to the keys/values of the previous steps
+                    k = torch.cat([cache['k'], k], dim=2)
+                    v = torch.cat([cache['v'], v], dim=2)
+                cache['k'], cache['v'] = k, v
 
         if mask is not None:
             mask = mask.unsqueeze(1)   # For head axis broadcasting.
@@ -12,7 +12,7 @@ class Translator(nn.Module):
     def __init__(
             self, model, beam_size, max_seq_len,
             src_pad_idx, trg_pad_idx, trg_bos_idx, trg_eos_idx):
-        
+
 
         super(Translator, self).__init__()
 
@@ -20,95 +20,111 @@ class Translator(nn.Module):
         self.beam_size = beam_size
         self.max_seq_len = max_seq_len
         self.src_pad_idx = src_pad_idx
+        self.trg_pad_idx = trg_pad_idx
         self.trg_bos_idx = trg_bos_idx
         self.trg_eos_idx = trg_eos_idx
 
         self.model = model
         self.model.eval()
 
-        self.register_buffer('init_seq', torch.LongTensor([[trg_bos_idx]]))
-        self.register_buffer(
-            'blank_seqs', 
-            torch.full((beam_size, max_seq_len), trg_pad_idx, dtype=torch.long))
-        self.blank_seqs[:, 0] = self.trg_bos_idx
         self.register_buffer(
-            'len_map', 
+            'len_map',
             torch.arange(1, max_seq_len + 1, dtype=torch.long).unsqueeze(0))
 
 
-    def _model_decode(self, trg_seq, enc_output, src_mask):
-        trg_mask = get_subsequent_mask(trg_seq)
-        dec_output, *_ = self.model.decoder(trg_seq, trg_mask, enc_output, src_mask)
-        return F.softmax(self.model.trg_word_prj(dec_output), dim=-1)
+    def _model_decode_step(self, trg_step, step, enc_output, src_mask, cache):
+        dec_output = self.model.decoder.forward_step(trg_step, step, enc_output, src_mask, cache)
+        return F.log_softmax(self.model.trg_word_prj(dec_output[:, -1, :]), dim=-1)
 
 
     def _get_init_state(self, src_seq, src_mask):
-        beam_size = self.beam_size
+        batch_size, beam_size = src_seq.size(0), self.beam_size
 
         enc_output, *_ = self.model.encoder(src_seq, src_mask)
-        dec_output = self._model_decode(self.init_seq, enc_output, src_mask)
-        
-        best_k_probs, best_k_idx = dec_output[:, -1, :].topk(beam_size)
+        # -- every sentence owns beam_size consecutive rows: b x ... -> (b*k) x ...
+        enc_output = enc_output.repeat_interleave(beam_size, dim=0)
+        src_mask = src_mask.repeat_interleave(beam_size, dim=0)
 
-        scores = torch.log(best_k_probs).view(beam_size)
-        gen_seq = self.blank_seqs.clone().detach()
-        gen_seq[:, 1] = best_k_idx[0]
-        enc_output = enc_output.repeat(beam_size, 1, 1)
-        return enc_output, gen_seq, scores
+        gen_seq = torch.full(
+            (batch_size * beam_size, self.max_seq_len), self.trg_pad_idx,
+            dtype=torch.long, device=src_seq.device)
+        gen_seq[:, 0] = self.trg_bos_idx
 
+        # -- only the first beam is alive at the start, otherwise all beams would pick the same tokens
+        scores = torch.full((batch_size, beam_size), float('-inf'), device=src_seq.device)
+        scores[:, 0] = 0
+        return enc_output, src_mask, gen_seq, scores.view(-1)
 
-    def _get_the_best_score_and_idx(self, gen_seq, dec_output, scores, step):
-        assert len(scores.size()) == 1
-        
+
+    def _get_the_best_score_and_idx(self, gen_seq, log_probs, scores, finished, step):
         beam_size = self.beam_size
+        vocab_size = log_probs.size(-1)
+        batch_size = log_probs.size(0) // beam_size
 
-        # Get k candidates for each beam, k^2 candidates in total.
-        best_k2_probs, best_k2_idx = dec_output[:, -1, :].topk(beam_size)
+        # A finished beam can only be extended by padding, and keeps its score.
+        log_probs = log_probs.masked_fill(finished.unsqueeze(1), float('-inf'))
+        log_probs[:, self.trg_pad_idx] = log_probs[:, self.trg_pad_idx].masked_fill(finished, 0)
 
-        # Include the previous scores.
-        scores = torch.log(best_k2_probs).view(beam_size, -1) + scores.view(beam_size, 1)
+        # Include the previous scores, then get the best k candidates of each sentence from its k*V candidates.
+        scores = (log_probs + scores.unsqueeze(1)).view(batch_size, -1)
+        scores, best_k_idx_in_kv = scores.topk(beam_size, dim=-1)
 
-        # Get the best k candidates from k^2 candidates.
-        scores, best_k_idx_in_k2 = scores.view(-1).topk(beam_size)
- 
-        # Get the corresponding positions of the best k candidiates.
-        best_k_r_idxs, best_k_c_idxs = best_k_idx_in_k2 // beam_size, best_k_idx_in_k2 % beam_size
-        best_k_idx = best_k2_idx[best_k_r_idxs, best_k_c_idxs]
+        # Get the corresponding beams (as rows of the flattened batch) and tokens.
+        beam_offset = torch.arange(batch_size, device=gen_seq.device).unsqueeze(1) * beam_size
+        best_k_r_idxs = (best_k_idx_in_kv // vocab_size + beam_offset).view(-1)
+        best_k_idx = (best_k_idx_in_kv % vocab_size).view(-1)
 
-        # Copy the corresponding previous tokens.
-        gen_seq[:, :step] = gen_seq[best_k_r_idxs, :step]
-        # Set the best tokens in this beam search step
+        # Copy the corresponding previous tokens, and set the best tokens in this beam search step.
+        gen_seq = gen_seq[best_k_r_idxs]
         gen_seq[:, step] = best_k_idx
+        finished = finished[best_k_r_idxs] | (best_k_idx == self.trg_eos_idx)
 
-        return gen_seq, scores
+        return gen_seq, scores.view(-1), finished, best_k_r_idxs
 
 
-    def translate_sentence(self, src_seq):
-        # Only accept batch size equals to 1 in this function.
-        # TODO: expand to batch operation.
-        assert src_seq.size(0) == 1
+    @staticmethod
+    def _reorder_cache(cache, beam_idx):
+        # Encoder-decoder attention caches are identical across the beams of one sentence,
+        # and beams are only ever reordered within their sentence, so they can stay as they are.
+        for slf_attn_cache, _ in cache:
+            slf_attn_cache['k'] = slf_attn_cache['k'].index_select(0, beam_idx)
+            slf_attn_cache['v'] = slf_attn_cache['v'].index_select(0, beam_idx)
+
 
-        src_pad_idx, trg_eos_idx = self.src_pad_idx, self.trg_eos_idx 
-        max_seq_len, beam_size, alpha = self.max_seq_len, self.beam_size, self.alpha 
+    def translate_batch(self, src_seq):
+        ''' Beam search over a batch of source sentences, returns one token id list per sentence. '''
+
+        src_pad_idx, trg_eos_idx = self.src_pad_idx, self.trg_eos_idx
+        max_seq_len, beam_size, alpha = self.max_seq_len, self.beam_size, self.alpha
+        batch_size = src_seq.size(0)
 
         with torch.no_grad():
             src_mask = get_pad_mask(src_seq, src_pad_idx)
-            enc_output, gen_seq, scores = self._get_init_state(src_seq, src_mask)
-
-            ans_idx = 0   # default
-            for step in range(2, max_seq_len):    # decode up to max length
-                dec_output = self._model_decode(gen_seq[:, :step], enc_output, src_mask)
-                gen_seq, scores = self._get_the_best_score_and_idx(gen_seq, dec_output, scores, step)
-
-                # Check if all path finished
-                # -- locate the eos in the generated sequences
-                eos_locs = gen_seq == trg_eos_idx   
-                # -- replace the eos with its position for the length penalty use
-                seq_lens, _ = self.len_map.masked_fill(~eos_locs, max_seq_len).min(1)
-                # -- check if all beams contain eos
-                if (eos_locs.sum(1) > 0).sum(0).item() == beam_size:
-                    # TODO: Try different terminate conditions.
-                    _, ans_idx = scores.div(seq_lens.float() ** alpha).max(0)
-                    ans_idx = ans_idx.item()
+            enc_output, src_mask, gen_seq, scores = self._get_init_state(src_seq, src_mask)
+            finished = torch.zeros(batch_size * beam_size, dtype=torch.bool, device=src_seq.device)
+            cache = self.model.decoder.init_cache()
+
+            for step in range(1, max_seq_len):    # decode up to max length
+                # -- only the newest position goes through the decoder, earlier ones come from the cache
+                log_probs = self._model_decode_step(
+                    gen_seq[:, step - 1:step], step - 1, enc_output, src_mask, cache)
+                gen_seq, scores, finished, beam_idx = self._get_the_best_score_and_idx(
+                    gen_seq, log_probs, scores, finished, step)
+                self._reorder_cache(cache, beam_idx)
+
+                # -- stop once every beam of every sentence has produced eos
+                if finished.all():
                     break
-        return gen_seq[ans_idx][:seq_lens[ans_idx]].tolist()
+
+            # -- replace the eos with its position for the length penalty use
+            eos_locs = gen_seq == trg_eos_idx
+            seq_lens, _ = self.len_map.masked_fill(~eos_locs, max_seq_len).min(1)
+            # -- pick the best finished hypothesis of each sentence under length penalty
+            penalized = scores.div(seq_lens.float() ** alpha).view(batch_size, beam_size)
+            ans_idx = penalized.argmax(dim=-1) + torch.arange(batch_size, device=src_seq.device) * beam_size
+
+        return [gen_seq[i][:seq_lens[i]].tolist() for i in ans_idx.tolist()]
+
+
+    def translate_sentence(self, src_seq):
+        return self.translate_batch(src_seq)[0]
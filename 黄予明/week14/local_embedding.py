@@ -1,8 +1,14 @@
 """
 本地Embedding模型 - 无需API Key
 使用Sentence Transformers库的预训练模型
+
+同一进程内每个模型只加载一次；向量按 (模型名, 文本) 的hash缓存在sqlite文件中，
+以fp16保存，多次运行、多个进程之间共享，重复的文档和查询不需要再次计算
 """
 
+import hashlib
+import sqlite3
+import threading
 import numpy as np
 from chromadb import Documents, EmbeddingFunction, Embeddings
 
@@ -13,6 +19,84 @@ except ImportError:
     SENTENCE_TRANSFORMERS_AVAILABLE = False
     print("需要安装sentence-transformers: pip install sentence-transformers")
 
+# 进程内共享的模型，key为模型名
+_MODELS = {}
+_MODELS_LOCK = threading.Lock()
+
+def get_model(model_name):
+    """加载模型，同一进程中相同模型只加载一次"""
+    with _MODELS_LOCK:
+        if model_name not in _MODELS:
+            _MODELS[model_name] = SentenceTransformer(model_name)
+        return _MODELS[model_name]
+
+
+class EmbeddingCache:
+    """
+    sqlite中保存的向量缓存
+    key为 模型名+文本 的sha1，value为fp16的向量二进制
+    使用WAL模式，多个进程可以同时读，写入时由sqlite加锁
+    """
+
+    def __init__(self, path="embedding_cache.sqlite"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(model_name, text):
+        return hashlib.sha1((model_name + "\0" + text).encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        """返回 {key: float32向量}，没有缓存的key不在结果中"""
+        result = {}
+        with self.lock:
+            # sqlite单条语句的参数个数有上限，分批查询
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                rows = self.conn.execute("SELECT key, vector FROM embeddings WHERE key IN (%s)" %
+                                         ",".join("?" * len(batch)), batch).fetchall()
+                for key, vector in rows:
+                    result[key] = np.frombuffer(vector, dtype=np.float16).astype(np.float32)
+        return result
+
+    def put_many(self, items):
+        """items: [(key, 向量)]"""
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                                  [(key, np.asarray(vector, dtype=np.float16).tobytes()) for key, vector in items])
+            self.conn.commit()
+
+
+def encode_with_cache(model, model_name, texts, cache=None, batch_size=32):
+    """
+    计算一组文本的向量：
+    1. 相同的文本只计算一次
+    2. 已缓存的直接读取
+    3. 未缓存的按长度排序后分批计算，同一批中的文本长度接近，padding更少
+    返回float32数组，缓存的向量是fp16，新计算的向量也转成fp16精度，保证每次结果一致
+    """
+    unique_texts = list(dict.fromkeys(texts))
+    keys = dict((text, EmbeddingCache.make_key(model_name, text)) for text in unique_texts)
+    vectors = {}
+    if cache is not None:
+        cached = cache.get_many(list(keys.values()))
+        vectors = dict((text, cached[keys[text]]) for text in unique_texts if keys[text] in cached)
+    missing = sorted((text for text in unique_texts if text not in vectors), key=len)
+    for i in range(0, len(missing), batch_size):
+        batch = missing[i:i + batch_size]
+        embeddings = model.encode(batch, batch_size=batch_size).astype(np.float16).astype(np.float32)
+        vectors.update(zip(batch, embeddings))
+        if cache is not None:
+            cache.put_many([(keys[text], vector) for text, vector in zip(batch, embeddings)])
+    if not texts:
+        return np.zeros((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+    return np.stack([vectors[text] for text in texts])
+
+
 class LocalEmbeddingFunction(EmbeddingFunction):
     """
     本地Embedding函数，使用Sentence Transformers
@@ -23,7 +107,7 @@ class LocalEmbeddingFunction(EmbeddingFunction):
     4. 支持中英文
     """
     
-    def __init__(self, model_name="all-MiniLM-L6-v2"):
+    def __init__(self, model_name="all-MiniLM-L6-v2", cache_path="embedding_cache.sqlite", batch_size=32):
         """
         初始化本地embedding模型
         
@@ -32,6 +116,8 @@ class LocalEmbeddingFunction(EmbeddingFunction):
                 - "all-MiniLM-L6-v2": 轻量级，英文为主，384维 (推荐)
                 - "paraphrase-multilingual-MiniLM-L12-v2": 多语言，384维
                 - "distiluse-base-multilingual-cased": 多语言，512维
+            cache_path: 向量缓存文件，为None时不使用缓存
+            batch_size: 每批计算的文本数
         """
         if not SENTENCE_TRANSFORMERS_AVAILABLE:
             raise ImportError("请安装sentence-transformers: pip install sentence-transformers")
@@ -40,14 +126,16 @@ class LocalEmbeddingFunction(EmbeddingFunction):
         print(f"🔄 正在加载本地embedding模型: {model_name}")
         
         try:
-            self.model = SentenceTransformer(model_name)
+            self.model = get_model(model_name)
             print(f"✅ 模型加载成功! 向量维度: {self.model.get_sentence_embedding_dimension()}")
         except Exception as e:
             print(f"❌ 模型加载失败: {e}")
             # 回退到更小的模型
             print("🔄 尝试加载备用模型...")
             self.model_name = "all-MiniLM-L6-v2"
-            self.model = SentenceTransformer(self.model_name)
+            self.model = get_model(self.model_name)
+        self.cache = EmbeddingCache(cache_path) if cache_path is not None else None
+        self.batch_size = batch_size
     
     def __call__(self, input: Documents) -> Embeddings:
         """
@@ -60,8 +148,8 @@ class LocalEmbeddingFunction(EmbeddingFunction):
             向量列表
         """
         try:
-            # 使用本地模型生成embedding
-            embeddings = self.model.encode(input)
+            # 使用本地模型生成embedding，已缓存的文本直接读取
+            embeddings = encode_with_cache(self.model, self.model_name, list(input), self.cache, self.batch_size)
             
             # 转换为列表格式（ChromaDB要求）
             return embeddings.tolist()
@@ -72,13 +160,16 @@ class LocalEmbeddingFunction(EmbeddingFunction):
             dim = self.model.get_sentence_embedding_dimension()
             return [[0.0] * dim] * len(input)
 
-def query_to_vector_local(text, model_name="all-MiniLM-L6-v2"):
+_CACHES = {}
+
+def query_to_vector_local(text, model_name="all-MiniLM-L6-v2", cache_path="embedding_cache.sqlite"):
     """
     单独的向量转换函数，用于测试
     
     Args:
         text: 要转换的文本
         model_name: 模型名称
+        cache_path: 向量缓存文件，为None时不使用缓存
     
     Returns:
         numpy数组格式的向量
@@ -88,8 +179,10 @@ def query_to_vector_local(text, model_name="all-MiniLM-L6-v2"):
         return None
     
     try:
-        model = SentenceTransformer(model_name)
-        vector = model.encode([text])
+        model = get_model(model_name)
+        if cache_path is not None and cache_path not in _CACHES:
+            _CACHES[cache_path] = EmbeddingCache(cache_path)
+        vector = encode_with_cache(model, model_name, [text], _CACHES.get(cache_path))
         return vector[0]  # 返回第一个结果
     except Exception as e:
         print(f"❌ 本地embedding失败: {e}")
@@ -1,7 +1,13 @@
 # RAG系统 - 使用本地Embedding模型
 # 无需API Key，完全离线运行
+#
+# 索引流程：文档流式切分成有重叠的段落 -> 分批embedding写入Chroma，段落文本同时保存一份用于BM25
+# 每个文件记录修改时间和内容hash，重启时只处理新增、修改、删除的文件，不会重复计算向量
+# 检索时BM25和向量检索各取一批段落，用RRF融合，交给大模型的只有少量相关段落
 
 import os
+import json
+import hashlib
 import numpy as np
 import chromadb
 from chromadb.config import Settings
@@ -12,21 +18,19 @@ import re
 print("🏠 启动本地RAG系统...")
 print("✅ 无需API Key，完全离线运行!")
 
+persist_directory = "./chroma_db_local"  # 本地存储目录
+manifest_path = os.path.join(persist_directory, "manifest.json")  # 每个文件的mtime、hash和段落id
+passages_path = os.path.join(persist_directory, "passages.json")  # 段落文本，BM25索引从这里构建
+
 # 初始化ChromaDB客户端
 client = chromadb.Client(Settings(
-    persist_directory="./chroma_db_local",  # 本地存储目录
+    persist_directory=persist_directory,
     is_persistent=True
 ))
 
-# 清理旧数据（可选）
-collections = client.list_collections()
-for collection in collections:
-    client.delete_collection(name=collection.name)
-    print(f"已删除旧集合: {collection.name}")
-
 # 创建使用本地Embedding的集合
 collection_name = "rag_local"
-print("🔄 正在创建集合并加载本地embedding模型...")
+print("🔄 正在加载集合和本地embedding模型...")
 
 # 选择embedding模型（根据需要调整）
 model_configs = {
@@ -37,67 +41,161 @@ model_configs = {
 # 使用轻量级模型（推荐）
 embedding_model = model_configs["multilingual"]
 
-collection = client.create_collection(
+# 已有集合直接复用，向量不需要重新计算
+collection = client.get_or_create_collection(
     name=collection_name,
     embedding_function=LocalEmbeddingFunction(model_name=embedding_model)
 )
-print(f"✅ 已创建本地embedding集合: {collection_name}")
-
-# 从Heroes文件夹加载英雄文档
-def load_hero_documents():
-    """加载Heroes文件夹下的所有英雄文档"""
-    heroes_dir = "./Heroes"
-    documents = []
-    ids = []
-    
+print(f"✅ 已加载本地embedding集合: {collection_name}，现有段落数: {collection.count()}")
+
+# 段落切分参数（按字符计）
+CHUNK_SIZE = 300
+CHUNK_OVERLAP = 60
+EMBED_BATCH_SIZE = 64
+
+def split_sentences(lines):
+    """逐行读取，按句号、问号、感叹号和换行切成句子"""
+    for line in lines:
+        for sentence in re.findall(r"[^。！？!?]+[。！？!?]?", line.strip()):
+            if sentence.strip():
+                yield sentence.strip()
+
+def split_passages(lines, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """
+    流式切分段落：句子累积到chunk_size就输出一段，
+    下一段以上一段末尾不超过overlap个字的完整句子开头，保证跨段的信息不被切断
+    超长的句子按chunk_size - overlap硬切，加上重叠部分后仍不超过chunk_size
+    """
+    chunk = []
+    length = 0
+    piece_size = chunk_size - overlap
+    for sentence in split_sentences(lines):
+        pieces = [sentence[i:i + piece_size] for i in range(0, len(sentence), piece_size)]
+        for piece in pieces:
+            if length + len(piece) > chunk_size and chunk:
+                yield "".join(chunk)
+                # 保留末尾的句子作为重叠部分
+                tail = []
+                tail_length = 0
+                for s in reversed(chunk):
+                    if tail_length + len(s) > overlap:
+                        break
+                    tail.insert(0, s)
+                    tail_length += len(s)
+                chunk, length = tail, tail_length
+            chunk.append(piece)
+            length += len(piece)
+    if chunk:
+        yield "".join(chunk)
+
+def file_hash(file_path):
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+def load_json(path):
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    return {}
+
+def save_json(data, path):
+    # 先写临时文件再替换，中途退出不会留下损坏的索引
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+def add_passages(passage_iter, passages):
+    """分批计算向量写入Chroma，返回写入的段落id"""
+    added = []
+    batch = []
+    for passage_id, source, text in passage_iter:
+        batch.append((passage_id, source, text))
+        if len(batch) >= EMBED_BATCH_SIZE:
+            added += flush_batch(batch, passages)
+            batch = []
+    if batch:
+        added += flush_batch(batch, passages)
+    return added
+
+def flush_batch(batch, passages):
+    collection.upsert(
+        ids=[passage_id for passage_id, _, _ in batch],
+        documents=[text for _, _, text in batch],
+        metadatas=[{"source": source} for _, source, _ in batch]
+    )
+    for passage_id, source, text in batch:
+        passages[passage_id] = {"source": source, "text": text}
+    return [passage_id for passage_id, _, _ in batch]
+
+def remove_passages(passage_ids, passages):
+    if passage_ids:
+        collection.delete(ids=passage_ids)
+    for passage_id in passage_ids:
+        passages.pop(passage_id, None)
+
+# 从Heroes文件夹增量更新索引
+def index_hero_documents(heroes_dir="./Heroes"):
+    """
+    对比manifest中记录的mtime和hash：
+      - mtime没变：跳过
+      - mtime变了但hash没变：只更新mtime
+      - 内容变了或新文件：删除旧段落，重新切分、计算向量
+      - 文件被删除：删除对应段落
+    """
+    manifest = load_json(manifest_path)
+    passages = load_json(passages_path)
+
     if not os.path.exists(heroes_dir):
         print(f"❌ Heroes文件夹不存在: {heroes_dir}")
-        return [], []
-    
+        return passages
+
     # 获取所有txt文件
-    txt_files = [f for f in os.listdir(heroes_dir) if f.endswith('.txt')]
-    
-    if not txt_files:
-        print(f"❌ 在{heroes_dir}中没有找到txt文件")
-        return [], []
-    
-    print(f"📁 正在加载 {len(txt_files)} 个英雄文档...")
-    
-    for i, filename in enumerate(txt_files):
+    txt_files = sorted(f for f in os.listdir(heroes_dir) if f.endswith('.txt'))
+    print(f"📁 正在检查 {len(txt_files)} 个英雄文档...")
+
+    updated = 0
+    for filename in txt_files:
         file_path = os.path.join(heroes_dir, filename)
+        mtime = os.path.getmtime(file_path)
+        record = manifest.get(filename)
+        if record is not None and record["mtime"] == mtime:
+            continue
+        digest = file_hash(file_path)
+        if record is not None and record["hash"] == digest:
+            record["mtime"] = mtime
+            continue
+        # 使用文件名（去掉.txt后缀）作为段落id的前缀
+        hero_name = filename.replace('.txt', '')
         try:
+            remove_passages(record["passage_ids"] if record else [], passages)
             with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read().strip()
-                if content:  # 确保文件不为空
-                    documents.append(content)
-                    # 使用文件名（去掉.txt后缀）作为ID
-                    hero_name = filename.replace('.txt', '')
-                    ids.append(f"hero_{hero_name}")
-                    print(f"   ✅ 已加载: {hero_name}")
+                passage_iter = ((f"hero_{hero_name}_{i}", hero_name, text)
+                                for i, text in enumerate(split_passages(f)))
+                passage_ids = add_passages(passage_iter, passages)
+            manifest[filename] = {"mtime": mtime, "hash": digest, "passage_ids": passage_ids}
+            updated += 1
+            print(f"   ✅ 已索引: {hero_name}，{len(passage_ids)} 个段落")
         except Exception as e:
             print(f"   ❌ 加载失败 {filename}: {e}")
-    
-    print(f"📊 成功加载 {len(documents)} 个英雄文档")
-    return documents, ids
 
-# 加载英雄文档
-documents, ids = load_hero_documents()
+    for filename in [f for f in manifest if f not in txt_files]:
+        remove_passages(manifest.pop(filename)["passage_ids"], passages)
+        updated += 1
+        print(f"   🗑️ 已删除: {filename}")
 
-if not documents:
-    print("❌ 没有加载到任何文档，程序退出")
-    exit(1)
+    save_json(passages, passages_path)
+    save_json(manifest, manifest_path)
+    print(f"📊 更新 {updated} 个文档，共 {len(manifest)} 个文档、{len(passages)} 个段落")
+    return passages
 
-print("📝 正在添加文档到向量数据库...")
-print("   第一次运行可能需要一些时间来处理向量...")
+# 更新索引
+passages = index_hero_documents()
 
-try:
-    collection.add(
-        documents=documents,
-        ids=ids
-    )
-    print(f"✅ 成功添加 {len(documents)} 个文档")
-except Exception as e:
-    print(f"❌ 添加文档失败: {e}")
+if not passages:
+    print("❌ 没有加载到任何文档，程序退出")
     exit(1)
 
 # -----------------------------
@@ -118,11 +216,12 @@ def tokenize(text: str):
         tokens.extend(list(span))
     return tokens
 
-# 构建 BM25 语料（使用与 Chroma 相同的 ids 对应）
-id_to_doc = {ids[i]: documents[i] for i in range(len(ids))}
-bm25_corpus = {ids[i]: tokenize(documents[i]) for i in range(len(documents))}
+# 构建 BM25 语料（使用与 Chroma 相同的段落 ids 对应）
+# idf依赖全部段落，每次启动从保存的段落文本重建，只做分词不需要计算向量
+id_to_doc = {passage_id: passage["text"] for passage_id, passage in passages.items()}
+bm25_corpus = {passage_id: tokenize(text) for passage_id, text in id_to_doc.items()}
 bm25_index = BM25(bm25_corpus)
-print(f"🔧 已构建 BM25 索引，文档数: {len(bm25_corpus)}，平均长度: {bm25_index.avgdl:.1f}")
+print(f"🔧 已构建 BM25 索引，段落数: {len(bm25_corpus)}，平均长度: {bm25_index.avgdl:.1f}")
 
 def search_bm25(query: str, top_k: int = 20):
     query_tokens = tokenize(query)
@@ -133,14 +232,14 @@ def search_bm25(query: str, top_k: int = 20):
 
 def search_vector(query: str, top_k: int = 20):
     try:
+        # ids 总会返回，不能放在 include 中；段落文本从 id_to_doc 中取
         results = collection.query(
             query_texts=[query],
-            n_results=top_k,
-            include=["documents", "ids", "distances"]
+            n_results=min(top_k, collection.count()),
+            include=["distances"]
         )
         # 统一返回 [(doc_id, score)]，将距离转为相似度分数
         vec_ids = results.get("ids", [[]])[0]
-        vec_docs = results.get("documents", [[]])[0]
         vec_dists = results.get("distances", [[]])[0]
         pairs = []
         for did, dist in zip(vec_ids, vec_dists):
@@ -279,7 +378,7 @@ if __name__ == "__main__":
     print(f"\n📊 系统信息:")
     print(f"   向量数据库: ChromaDB")
     print(f"   嵌入模型: {embedding_model}")
-    print(f"   英雄文档数量: {len(documents)}")
+    print(f"   英雄文档段落数量: {len(passages)}")
     print(f"   存储位置: ./chroma_db_local")
     print(f"   运行模式: 完全离线")
     print(f"   数据来源: Heroes文件夹")
@@ -1,167 +1,263 @@
+import os
 import re
+import csv
 import json
+import time
+import threading
 from py2neo import Graph
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+流式构建知识图谱
+三元组文件逐行读取，按关系类型/标签分组攒成批次，用参数化的 UNWIND $rows 语句写入，
+不再拼接一整段Cypher，属性值也不需要手动转义
+多个写入线程并发提交批次，每个线程使用自己的连接
+也可以导出为 neo4j-admin import 使用的csv文件，离线批量导入
+"""
 
-\
 #连接图数据库
-graph = Graph("http://localhost:7474",auth=("neo4j","demo"))
+NEO4J_URI = "http://localhost:7474"
+NEO4J_AUTH = ("neo4j", "demo")
+
+LABELS = ["歌曲", "专辑", "电影", "电视剧"]
 
-attribute_data = defaultdict(dict)
-relation_data = defaultdict(dict)
-label_data = {}
+#所有节点都带Entity标签，NAME上建唯一约束，MERGE走索引，并发写入同一节点时也不会重复创建
+NODE_QUERY = "UNWIND $rows AS row MERGE (n:Entity {NAME: row.name}) SET n += row.props"
+LABEL_QUERY = "UNWIND $rows AS row MERGE (n:Entity {NAME: row.name}) SET n:`%s`"
+RELATION_QUERY = ("UNWIND $rows AS row MERGE (h:Entity {NAME: row.head}) MERGE (t:Entity {NAME: row.tail}) "
+                  "MERGE (h)-[:`%s`]->(t)")
 
 
-# 提取到标签后，把括号部分删除
-def get_label_then_clean(x, label_data):
+# 提取到标签后，把括号部分删除，返回(实体名, 标签)，没有标签时标签为None
+def get_label_then_clean(x):
+    label = None
     if re.search("（.+）", x):
         label_string = re.search("（.+）", x).group()
-        for label in ["歌曲", "专辑", "电影", "电视剧"]:
-            if label in label_string:
-                x = re.sub("（.+）", "", x)  # 括号内的内容删掉，因为括号是特殊字符会影响cypher语句运行 # 有的实体后面有括号，里面的内容可以作为标签
-                label_data[x] = label
-            else:
-                x = re.sub("（.+）", "", x)
-    return x
-
-# 读取all_triplets.txt文件 实体-关系-实体 
-print("开始读取all_triplets.txt文件...")
-with open("all_triplets.txt", encoding="utf8") as f:
-    line_count = 0
-    for line in f:
-        try:
-            head, relation, tail = line.strip().split("\t")  #取出三元组
-            head = get_label_then_clean(head, label_data)
-            relation_data[head][relation] = tail
-            line_count += 1
-            
-            if line_count % 100 == 0:
-                print(f"已处理 {line_count} 个关系三元组")
-                
-        except Exception as e:
-            print(f"处理行出错: {line.strip()} - {e}")
-            continue
-
-print(f"完成读取 {line_count} 个关系三元组")
-
-#读取实体-属性-属性值三元组文件 
-print("开始读取triplets_enti_attr_value.txt文件...")
-with open("triplets_enti_attr_value.txt", encoding="utf8") as f:
-    attr_count = 0
-    for line in f:
-        try:
-            entity, attribute, value = line.strip().split("\t")  # 取出三元组
-            entity = get_label_then_clean(entity, label_data)
-            attribute_data[entity][attribute] = value
-            attr_count += 1
-            
-        except Exception as e:
-            print(f"处理属性行出错: {line.strip()} - {e}")
-            continue
-
-print(f"完成读取 {attr_count} 个属性三元组")
-
-#构建cypher语句
-print("开始构建Cypher语句...")
-cypher = ""
-in_graph_entity = set()
-
-for i, entity in enumerate(attribute_data):
-    #为所有的实体增加一个名字属性
-    attribute_data[entity]["NAME"] = entity
-    #将一个实体的所有属性拼接成一个类似字典的表达式
-    text = "{"
-    for attribute, value in attribute_data[entity].items():
-        # 转义特殊字符
-        escaped_value = value.replace("'", "\\'").replace('"', '\\"')
-        text += "%s:'%s',"%(attribute, escaped_value)
-    text = text[:-1] + "}"  #最后一个逗号替换为大括号
-    
-    if entity in label_data:
-        label = label_data[entity]
-        #带标签的实体构建语句
-        cypher += "CREATE (%s:%s %s)" % (entity, label, text) + "\n"
+        for l in LABELS:
+            if l in label_string:
+                label = l
+                break
+        x = re.sub("（.+）", "", x)
+    return x, label
+
+#标签、关系名作为语句的一部分，不能参数化，反引号需要转义
+def quote_name(name):
+    return name.replace("`", "``")
+
+#逐行读取三元组，格式不对的行跳过
+def iter_triplets(path):
+    with open(path, encoding="utf8") as f:
+        for line_count, line in enumerate(f, 1):
+            parts = line.strip().split("\t")
+            if len(parts) != 3:
+                if line.strip():
+                    print(f"处理行出错: {line.strip()}")
+                continue
+            yield parts
+            if line_count % 100000 == 0:
+                print(f"{path} 已读取 {line_count} 行")
+
+#按key分组攒批，某一组攒满batch_size就输出，内存中最多保留每组一个批次
+def group_batches(items, batch_size):
+    buffers = defaultdict(list)
+    for key, row in items:
+        buffers[key].append(row)
+        if len(buffers[key]) >= batch_size:
+            yield key, buffers.pop(key)
+    for key, rows in buffers.items():
+        yield key, rows
+
+
+class Schema:
+    def __init__(self):
+        self.data = defaultdict(set)
+        self.entity_labels = set()
+
+    #返回是否是新出现的(实体, 标签)，同一个标签只需要写入一次
+    def add_label(self, entity, label):
+        if label is None or (entity, label) in self.entity_labels:
+            return False
+        self.entity_labels.add((entity, label))
+        self.data["entitys"].add(entity)
+        self.data["labels"].add(label)
+        return True
+
+    def add_relation(self, head, relation, tail):
+        self.data["entitys"].update([head, tail])
+        self.data["relations"].add(relation)
+
+    def add_attribute(self, entity, attribute):
+        self.data["entitys"].add(entity)
+        self.data["attributes"].add(attribute)
+
+    def save(self, path="kg_schema.json"):
+        data = dict((x, list(y)) for x, y in self.data.items())
+        print(f"\n图谱构建统计:")
+        print(f"  实体数量: {len(data.get('entitys', []))}")
+        print(f"  属性数量: {len(data.get('attributes', []))}")
+        print(f"  关系数量: {len(data.get('relations', []))}")
+        print(f"  标签数量: {len(data.get('labels', []))}")
+        with open(path, "w", encoding="utf8") as f:
+            f.write(json.dumps(data, ensure_ascii=False, indent=2))
+        print(f"Schema文件已保存到 {path}")
+
+
+#属性文件中同一实体的属性通常是连续的，连续的行合并成一个节点写入
+def iter_node_rows(attr_path, schema):
+    name, props = None, {}
+    for entity, attribute, value in iter_triplets(attr_path):
+        entity, label = get_label_then_clean(entity)
+        schema.add_attribute(entity, attribute)
+        if schema.add_label(entity, label):
+            yield ("label", label), {"name": entity}
+        if entity != name and name is not None:
+            yield ("node",), {"name": name, "props": props}
+            props = {}
+        name = entity
+        props[attribute] = value
+    if name is not None:
+        yield ("node",), {"name": name, "props": props}
+
+def iter_relation_rows(triplet_path, schema):
+    for head, relation, tail in iter_triplets(triplet_path):
+        head, head_label = get_label_then_clean(head)
+        tail, tail_label = get_label_then_clean(tail)
+        schema.add_relation(head, relation, tail)
+        for entity, label in [(head, head_label), (tail, tail_label)]:
+            if schema.add_label(entity, label):
+                yield ("label", label), {"name": entity}
+        yield ("relation", relation), {"head": head, "tail": tail}
+
+
+class GraphWriter:
+    def __init__(self, uri=NEO4J_URI, auth=NEO4J_AUTH, workers=4, max_retry=3):
+        self.uri = uri
+        self.auth = auth
+        self.workers = workers
+        self.max_retry = max_retry
+        self.local = threading.local()
+        self.written = 0
+        self.failed = []  #重试后仍然失败的批次 (query, rows, 错误信息)
+        self.lock = threading.Lock()
+
+    #每个线程一个连接
+    def graph(self):
+        if not hasattr(self.local, "graph"):
+            self.local.graph = Graph(self.uri, auth=self.auth)
+        return self.local.graph
+
+    def prepare(self, clear=True, delete_batch=10000):
+        graph = self.graph()
+        if clear:
+            #分批删除，避免一个事务删除整个图谱
+            print("清空现有图谱数据...")
+            while graph.run("MATCH (n) WITH n LIMIT %d DETACH DELETE n RETURN count(*) AS c" %
+                            delete_batch).evaluate():
+                pass
+        graph.run("CREATE CONSTRAINT entity_name IF NOT EXISTS FOR (n:Entity) REQUIRE n.NAME IS UNIQUE")
+
+    #并发写入时多个事务锁同一节点可能死锁，失败后重试
+    def write(self, query, rows):
+        for attempt in range(self.max_retry):
+            try:
+                self.graph().run(query, rows=rows)
+                break
+            except Exception as e:
+                if attempt == self.max_retry - 1:
+                    print(f"批次执行出错: {e}")
+                    with self.lock:
+                        self.failed.append((query, rows, str(e)))
+                    return
+                time.sleep(0.1 * (attempt + 1))
+        with self.lock:
+            self.written += len(rows)
+
+    #提交中的批次数量有上限，读文件的速度不会超过写入速度太多
+    def write_batches(self, batches):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = []
+            for batch_count, (key, rows) in enumerate(batches, 1):
+                if key[0] == "node":
+                    query = NODE_QUERY
+                elif key[0] == "label":
+                    query = LABEL_QUERY % quote_name(key[1])
+                else:
+                    query = RELATION_QUERY % quote_name(key[1])
+                pending.append(executor.submit(self.write, query, rows))
+                if len(pending) >= self.workers * 2:
+                    pending.pop(0).result()
+                if batch_count % 100 == 0:
+                    print(f"已写入 {self.written} 行")
+            for future in pending:
+                future.result()
+        print(f"已写入 {self.written} 行")
+
+    #把失败的批次写入文件，便于排查后重新导入
+    def save_failed(self, path="failed_batches.jsonl"):
+        with open(path, "w", encoding="utf8") as f:
+            for query, rows, error in self.failed:
+                f.write(json.dumps({"query": query, "rows": rows, "error": error}, ensure_ascii=False) + "\n")
+
+
+#先写节点和属性，再写关系
+#有批次重试后仍然失败时，失败的批次保存到failed_batches.jsonl，并抛出异常，不会当作构建成功
+def load_graph(triplet_path="all_triplets.txt", attr_path="triplets_enti_attr_value.txt",
+               node_batch_size=1000, relation_batch_size=5000, workers=4, clear=True):
+    schema = Schema()
+    writer = GraphWriter(workers=workers)
+    writer.prepare(clear)
+    start_time = time.time()
+    print(f"开始读取{attr_path}文件...")
+    writer.write_batches(group_batches(iter_node_rows(attr_path, schema), node_batch_size))
+    print(f"开始读取{triplet_path}文件...")
+    writer.write_batches(group_batches(iter_relation_rows(triplet_path, schema), relation_batch_size))
+    if writer.failed:
+        writer.save_failed()
+        raise RuntimeError(f"{len(writer.failed)} 个批次、{sum(len(rows) for _, rows, _ in writer.failed)} 行写入失败，"
+                           f"已保存到 failed_batches.jsonl")
+    print(f"图谱构建成功！耗时 {time.time() - start_time:.2f} 秒")
+    return schema
+
+
+#导出 neo4j-admin database import full --nodes=nodes.csv --relationships=relationships.csv 使用的文件
+#关系边读边写；节点的属性列需要事先确定，所以属性文件会汇总到内存中
+def export_csv(triplet_path="all_triplets.txt", attr_path="triplets_enti_attr_value.txt", output_dir="import"):
+    os.makedirs(output_dir, exist_ok=True)
+    schema = Schema()
+    labels = defaultdict(set)
+    with open(os.path.join(output_dir, "relationships.csv"), "w", encoding="utf8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow([":START_ID", ":END_ID", ":TYPE"])
+        seen = set()
+        for key, row in iter_relation_rows(triplet_path, schema):
+            if key[0] == "label":
+                labels[row["name"]].add(key[1])
+            elif (row["head"], key[1], row["tail"]) not in seen:  #与MERGE一致，重复的关系只保留一条
+                seen.add((row["head"], key[1], row["tail"]))
+                writer.writerow([row["head"], row["tail"], key[1]])
+    properties = defaultdict(dict)
+    for key, row in iter_node_rows(attr_path, schema):
+        if key[0] == "label":
+            labels[row["name"]].add(key[1])
+        else:
+            properties[row["name"]].update(row["props"])
+    attributes = sorted(schema.data["attributes"])
+    with open(os.path.join(output_dir, "nodes.csv"), "w", encoding="utf8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["NAME:ID", ":LABEL"] + attributes)
+        for entity in sorted(schema.data["entitys"]):
+            label = ";".join(["Entity"] + sorted(labels[entity]))
+            writer.writerow([entity, label] + [properties[entity].get(a, "") for a in attributes])
+    print(f"csv文件已保存到 {output_dir}")
+    return schema
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "csv":
+        schema = export_csv()
     else:
-        #不带标签的实体构建语句
-        cypher += "CREATE (%s:Entity %s)" % (entity, text) + "\n"
-    in_graph_entity.add(entity)
-
-#构建关系语句
-for i, head in enumerate(relation_data):
-    # 有可能实体只有和其他实体的关系，但没有属性，为这样的实体增加一个名称属性，便于在图上认出
-    if head not in in_graph_entity:
-        cypher += "CREATE (%s:Entity {NAME:'%s'})" % (head, head) + "\n"
-        in_graph_entity.add(head)
-
-    for relation, tail in relation_data[head].items():
-        # 有可能实体只有和其他实体的关系，但没有属性，为这样的实体增加一个名称属性，便于在图上认出
-        if tail not in in_graph_entity:
-            cypher += "CREATE (%s:Entity {NAME:'%s'})" % (tail, tail) + "\n"
-            in_graph_entity.add(tail)
-
-        #关系语句
-        cypher += "CREATE (%s)-[:%s]->(%s)" % (head, relation, tail) + "\n"
-
-print(f"Cypher语句构建完成，准备创建 {len(in_graph_entity)} 个实体")
-
-# 清空现有数据
-print("清空现有图谱数据...")
-graph.run("MATCH (n) DETACH DELETE n")
-
-#执行建表脚本
-try:
-    graph.run(cypher)
-    print("图谱构建成功！")
-except Exception as e:
-    print(f"执行Cypher出错: {e}")
-    print("尝试分批执行...")
-    
-    # 分批执行避免大量数据导致的问题
-    cypher_lines = [line for line in cypher.strip().split('\n') if line.strip()]
-    batch_size = 50
-    success_count = 0
-    
-    for i in range(0, len(cypher_lines), batch_size):
-        batch = cypher_lines[i:i+batch_size]
-        batch_cypher = '\n'.join(batch)
-        
-        try:
-            graph.run(batch_cypher)
-            success_count += len(batch)
-            print(f"已成功执行 {success_count}/{len(cypher_lines)} 条语句")
-        except Exception as batch_error:
-            print(f"批次执行出错: {batch_error}")
-
-
-print("生成图谱schema...")
-data = defaultdict(set)
-
-for head in relation_data:
-    data["entitys"].add(head)
-    for relation, tail in relation_data[head].items():
-        data["relations"].add(relation)
-        data["entitys"].add(tail)
-
-for enti, label in label_data.items():
-    data["entitys"].add(enti)
-    data["labels"].add(label)
-
-for enti in attribute_data:
-    for attr, value in attribute_data[enti].items():
-        data["entitys"].add(enti)
-        data["attributes"].add(attr)
-
-data = dict((x, list(y)) for x, y in data.items())
-
-# 输出统计信息
-print(f"\n图谱构建统计:")
-print(f"  实体数量: {len(data.get('entitys', []))}")
-print(f"  属性数量: {len(data.get('attributes', []))}")  
-print(f"  关系数量: {len(data.get('relations', []))}")
-print(f"  标签数量: {len(data.get('labels', []))}")
-
-with open("kg_schema.json", "w", encoding="utf8") as f:
-    f.write(json.dumps(data, ensure_ascii=False, indent=2))
-
-print("Schema文件已保存到 kg_schema.json")
-print("图谱构建完成！")
+        schema = load_graph()
+    schema.save("kg_schema.json")
+    print("图谱构建完成！")
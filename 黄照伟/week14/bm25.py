@@ -3,45 +3,75 @@ import math
 import os
 import pickle
 import sys
+import time
 from typing import Dict, List
 
+import numpy as np
+
 
 class BM25:
+    """
+    倒排索引版本的BM25
+    建索引时为每个(词, 文档)预先算好BM25权重，按词连续存放(CSR格式)：
+        offsets[t]:offsets[t+1] 是词t的倒排表，postings_doc是文档编号(升序)，postings_weight是对应权重
+    查询时只累加查询词倒排表中出现的文档，再取top-k，不需要遍历所有文档
+    得分与逐个文档计算的结果完全一致
+    """
     EPSILON = 0.25
     PARAM_K1 = 1.5
     PARAM_B = 0.6
 
     def __init__(self, corpus: Dict):
-        self.corpus_size = 0
-        self.wordNumsOfAllDoc = 0
-        self.doc_freqs = {}
-        self.idf = {}
-        self.doc_len = {}
-        self.docContainedWord = {}
-        self._initialize(corpus)
+        self._initialize(corpus.items())
 
-    def _initialize(self, corpus: Dict):
-        for index, document in corpus.items():
-            self.corpus_size += 1
-            self.doc_len[index] = len(document)
-            self.wordNumsOfAllDoc += len(document)
+    #corpus可以是任意(文档id, 词列表)的迭代器，文档很多时不需要先放进一个dict
+    @classmethod
+    def from_documents(cls, documents):
+        bm25 = cls.__new__(cls)
+        bm25._initialize(documents)
+        return bm25
+
+    def _initialize(self, documents):
+        self.doc_index = []            #内部编号 -> 文档id
+        self.word_to_id = {}
+        self.words = []
+        doc_lens = []
+        posting_word, posting_doc, posting_tf = [], [], []
+        for index, document in documents:
+            doc_id = len(self.doc_index)
+            self.doc_index.append(index)
+            doc_lens.append(len(document))
 
             frequencies = {}
             for word in document:
                 if word not in frequencies:
                     frequencies[word] = 0
                 frequencies[word] += 1
-            self.doc_freqs[index] = frequencies
 
-            for word in frequencies.keys():
-                if word not in self.docContainedWord:
-                    self.docContainedWord[word] = set()
-                self.docContainedWord[word].add(index)
+            for word, tf in frequencies.items():
+                if word not in self.word_to_id:
+                    self.word_to_id[word] = len(self.words)
+                    self.words.append(word)
+                posting_word.append(self.word_to_id[word])
+                posting_doc.append(doc_id)
+                posting_tf.append(tf)
+
+        self.corpus_size = len(self.doc_index)
+        self.doc_lens = np.array(doc_lens, dtype=np.int64)
+        self.wordNumsOfAllDoc = int(self.doc_lens.sum())
 
+        #按词排序，同一个词内部保持文档编号升序
+        posting_word = np.array(posting_word, dtype=np.int64)
+        order = np.argsort(posting_word, kind="stable")
+        self.postings_doc = np.array(posting_doc, dtype=np.int32)[order]
+        postings_tf = np.array(posting_tf, dtype=np.float64)[order]
+        doc_nums = np.bincount(posting_word, minlength=len(self.words))
+        self.offsets = np.concatenate([[0], np.cumsum(doc_nums)]).astype(np.int64)
+
+        self.idf = {}
         idf_sum = 0
         negative_idfs = []
-        for word in self.docContainedWord.keys():
-            doc_nums_contained_word = len(self.docContainedWord[word])
+        for word, doc_nums_contained_word in zip(self.words, doc_nums.tolist()):
             idf = math.log(self.corpus_size - doc_nums_contained_word + 0.5) - math.log(doc_nums_contained_word + 0.5)
             self.idf[word] = idf
             idf_sum += idf
@@ -51,22 +81,175 @@ class BM25:
         eps = BM25.EPSILON * average_idf
         for word in negative_idfs:
             self.idf[word] = eps
+        idf = np.array([self.idf[word] for word in self.words])
+
+        k1 = BM25.PARAM_K1
+        b = BM25.PARAM_B
+        posting_idf = np.repeat(idf, doc_nums)
+        posting_len = self.doc_lens[self.postings_doc]
+        self.postings_weight = posting_idf * postings_tf * (k1 + 1) / (
+                postings_tf + k1 * (1 - b + b * posting_len / self.avgdl))
+        self._init_buffer()
+
+    def _init_buffer(self):
+        self.position = dict((index, doc_id) for doc_id, index in enumerate(self.doc_index))
+        self.score_buffer = np.zeros(self.corpus_size, dtype=np.float64)
 
     @property
     def avgdl(self):
         return float(self.wordNumsOfAllDoc) / self.corpus_size
 
+    def postings(self, word):
+        word_id = self.word_to_id.get(word)
+        if word_id is None:
+            return self.postings_doc[:0], self.postings_weight[:0]
+        begin, end = self.offsets[word_id], self.offsets[word_id + 1]
+        return self.postings_doc[begin:end], self.postings_weight[begin:end]
+
     def get_score(self, query: List, doc_index):
-        k1 = BM25.PARAM_K1
-        b = BM25.PARAM_B
+        doc_id = self.position[doc_index]
         score = 0
-        doc_freqs = self.doc_freqs[doc_index]
         for word in query:
-            if word not in doc_freqs:
-                continue
-            score += self.idf[word] * doc_freqs[word] * (k1 + 1) / (
-                        doc_freqs[word] + k1 * (1 - b + b * self.doc_len[doc_index] / self.avgdl))
-        return [doc_index,score]
-    def get_scores(self,query):
-        scores = [self.get_score(query,index) for index in self.doc_len.keys()]
-        return scores
+            docs, weights = self.postings(word)
+            i = np.searchsorted(docs, doc_id)
+            if i < len(docs) and docs[i] == doc_id:
+                score += weights[i]
+        return [doc_index, float(score)]
+
+    #累加查询词倒排表上的权重，返回命中的文档内部编号和得分
+    #重复的查询词会重复累加，与逐词计算的顺序相同，浮点结果也完全一致
+    #倒排表较短时对命中的文档去重；包含高频词时直接扫描整个得分数组更快
+    def accumulate(self, query: List):
+        touched = []
+        num_postings = 0
+        for word in query:
+            docs, weights = self.postings(word)
+            if len(docs):
+                self.score_buffer[docs] += weights
+                touched.append(docs)
+                num_postings += len(docs)
+        if not touched:
+            return np.zeros(0, dtype=np.int32), np.zeros(0)
+        if num_postings * 16 < self.corpus_size:
+            docs = np.unique(np.concatenate(touched))
+            scores = self.score_buffer[docs]
+            self.score_buffer[docs] = 0
+        else:
+            docs = np.flatnonzero(self.score_buffer)
+            scores = self.score_buffer[docs]
+            self.score_buffer[:] = 0
+        return docs, scores
+
+    def get_scores(self, query):
+        docs, scores = self.accumulate(query)
+        all_scores = np.zeros(self.corpus_size)
+        all_scores[docs] = scores
+        return [[index, score] for index, score in zip(self.doc_index, all_scores.tolist())]
+
+    #返回得分最高的k个[文档id, 得分]，得分相同时文档顺序靠前的优先，与对全部得分稳定排序的结果一致
+    #idf可能为负(文档很少时平均idf为负，修正值eps也为负)，所以按 正分 > 0分 > 负分 三段处理：
+    #正分足够k个时只在正分里取top-k；不够时依次用0分的文档(包括没有命中的)按顺序、负分的文档按得分补齐
+    def get_top_k(self, query: List, k=1):
+        docs, scores = self.accumulate(query)
+        positive = scores > 0
+        top_docs, top_scores = docs[positive], scores[positive]
+        if len(top_docs) > k:
+            threshold = np.partition(top_scores, len(top_scores) - k)[len(top_scores) - k]
+            keep = top_scores >= threshold
+            top_docs, top_scores = top_docs[keep], top_scores[keep]
+        result = self.sorted_docs(top_docs, top_scores)[:k]
+        if len(result) < k:
+            nonzero = set(docs[scores != 0].tolist())
+            for doc_id in range(self.corpus_size):
+                if len(result) >= k:
+                    break
+                if doc_id not in nonzero:
+                    result.append([self.doc_index[doc_id], 0.0])
+        if len(result) < k:
+            negative = scores < 0
+            result += self.sorted_docs(docs[negative], scores[negative])[:k - len(result)]
+        return result
+
+    #按得分降序、文档编号升序排列
+    def sorted_docs(self, docs, scores):
+        order = np.lexsort((docs, -scores))
+        return [[self.doc_index[doc_id], score] for doc_id, score in zip(docs[order].tolist(), scores[order].tolist())]
+
+    def save(self, path):
+        meta = {"doc_index": self.doc_index, "words": self.words, "wordNumsOfAllDoc": self.wordNumsOfAllDoc}
+        np.savez(path, offsets=self.offsets, postings_doc=self.postings_doc, postings_weight=self.postings_weight,
+                 doc_lens=self.doc_lens, idf=np.array([self.idf[word] for word in self.words]),
+                 meta=np.frombuffer(json.dumps(meta, ensure_ascii=False).encode("utf8"), dtype=np.uint8))
+
+    @classmethod
+    def load(cls, path):
+        bm25 = cls.__new__(cls)
+        with np.load(path) as data:
+            meta = json.loads(data["meta"].tobytes().decode("utf8"))
+            bm25.offsets = data["offsets"]
+            bm25.postings_doc = data["postings_doc"]
+            bm25.postings_weight = data["postings_weight"]
+            bm25.doc_lens = data["doc_lens"]
+            idf = data["idf"].tolist()
+        bm25.doc_index = meta["doc_index"]
+        bm25.words = meta["words"]
+        bm25.wordNumsOfAllDoc = meta["wordNumsOfAllDoc"]
+        bm25.corpus_size = len(bm25.doc_index)
+        bm25.word_to_id = dict((word, i) for i, word in enumerate(bm25.words))
+        bm25.idf = dict(zip(bm25.words, idf))
+        bm25._init_buffer()
+        return bm25
+
+
+#在随机的小语料上对比get_top_k与逐个文档计算得分后稳定排序的结果
+#小语料中高频词的idf为负，可以覆盖负分、0分和没有命中的文档混在一起的情况
+def check_top_k(num_cases=3000, seed=0):
+    rng = np.random.default_rng(seed)
+    for _ in range(num_cases):
+        corpus = dict(("doc%d" % i, rng.integers(0, 6, rng.integers(1, 6)).tolist())
+                      for i in range(rng.integers(1, 8)))
+        bm25 = BM25(corpus)
+        query = rng.integers(0, 8, rng.integers(0, 4)).tolist()
+        scores = [bm25.get_score(query, index) for index in corpus]
+        expected = sorted(scores, key=lambda x: x[1], reverse=True)
+        for k in range(1, len(corpus) + 2):
+            assert bm25.get_top_k(query, k) == expected[:k], (corpus, query, k)
+    print("get_top_k与稳定排序结果一致：%d组随机语料" % num_cases)
+
+
+#生成num_docs篇词频服从zipf分布的随机文档，测试建索引和查询的耗时
+def benchmark(num_docs=1000000, doc_len=30, vocab_size=50000, num_queries=200, query_len=5, k=10):
+    rng = np.random.default_rng(0)
+
+    def documents():
+        for i in range(num_docs):
+            yield i, (rng.zipf(1.2, doc_len) % vocab_size).tolist()
+
+    start_time = time.time()
+    bm25 = BM25.from_documents(documents())
+    print("建索引：%d篇文档，%d个倒排项，耗时%.2f秒" % (num_docs, len(bm25.postings_doc), time.time() - start_time))
+
+    queries = [(rng.zipf(1.2, query_len) % vocab_size).tolist() for _ in range(num_queries)]
+    start_time = time.time()
+    for query in queries:
+        bm25.get_top_k(query, k)
+    print("倒排索引top-%d：平均每个查询%.3f毫秒" % (k, (time.time() - start_time) / num_queries * 1000))
+
+    #对照：计算全部文档得分再排序
+    start_time = time.time()
+    for query in queries[:20]:
+        scores = sorted(bm25.get_scores(query), key=lambda x: x[1], reverse=True)
+        assert [doc for doc, _ in scores[:k]] == [doc for doc, _ in bm25.get_top_k(query, k)]
+    print("全部得分排序：平均每个查询%.3f毫秒" % ((time.time() - start_time) / 20 * 1000))
+
+    start_time = time.time()
+    bm25.save("bm25_benchmark.npz")
+    loaded = BM25.load("bm25_benchmark.npz")
+    print("保存+加载耗时%.2f秒" % (time.time() - start_time))
+    assert loaded.get_top_k(queries[0], k) == bm25.get_top_k(queries[0], k)
+    os.remove("bm25_benchmark.npz")
+
+
+if __name__ == "__main__":
+    check_top_k()
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
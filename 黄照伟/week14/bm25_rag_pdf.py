@@ -1,68 +1,173 @@
 import PyPDF2
 import os
+import sys
+import json
+import time
+import hashlib
 import jieba
+from concurrent.futures import ProcessPoolExecutor
 from config import Config
-from openai import OpenAI
 from bm25 import BM25
+from llm_backend import OpenAIBackend, FakeBackend
 
-def call_large_model(prompt):
-    client = OpenAI(
-        api_key= Config["api_key"],
-        base_url = "https://dashscope.aliyuncs.com/compatible-mode/v1",
-    )
-    completion = client.chat.completions.create(
-        model = "qwen-plus",
-        messages = [
-            {"role": "user", "content": prompt}
-        ],
-    )
-    return completion.choices[0].message.content
+#全局共用一个客户端，不再每次调用都新建
+default_backend = OpenAIBackend(api_key=Config["api_key"], model="qwen-plus")
+
+def call_large_model(prompt, backend=None):
+    return (backend or default_backend).generate(prompt)
+
+#逐页抽取文本并分词，只在最后拼接一次，不在循环里反复拼接大字符串
+#放在模块顶层，进程池中的子进程才能调用
+def extract_pdf(file_path):
+    pages = []
+    tokens = []
+    with open(file_path,"rb") as f:
+        pdf_reader = PyPDF2.PdfReader(f)
+        for page in pdf_reader.pages:
+            page_text = page.extract_text() or ""
+            pages.append(page_text)
+            tokens.extend(jieba.lcut(page_text))
+    return "".join(pages), tokens
+
+def file_hash(file_path):
+    md5 = hashlib.md5()
+    with open(file_path,"rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+#分词结果依赖jieba版本和词典，记录在缓存里，变化后重新抽取
+#注意：jieba.load_userdict/add_word添加的词不在其中，修改了自定义词时需要手动清空缓存目录
+def tokenizer_signature():
+    dictionary = jieba.dt.dictionary
+    if dictionary is None:
+        return "jieba-%s:default" % jieba.__version__
+    dictionary = os.path.abspath(dictionary)
+    return "jieba-%s:%s:%s" % (jieba.__version__, dictionary, os.path.getmtime(dictionary))
+
+#抽取结果按文件缓存：mtime和大小没变直接使用；变了再比较内容hash，内容没变只更新mtime
+#缓存文件损坏或分词器不一致时当作没有缓存
+class PdfCache:
+    def __init__(self,cache_dir=".pdf_cache"):
+        self.cache_dir = cache_dir
+        self.tokenizer = tokenizer_signature()
+        os.makedirs(cache_dir,exist_ok=True)
+    def path(self,file_path):
+        name = hashlib.md5(os.path.abspath(file_path).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir,name + ".json")
+    def get(self,file_path):
+        if not os.path.exists(self.path(file_path)):
+            return None, None
+        try:
+            with open(self.path(file_path),encoding="utf-8") as f:
+                record = json.load(f)
+            if record["tokenizer"] != self.tokenizer:
+                return None, None
+            stat = os.stat(file_path)
+            if record["mtime"] == stat.st_mtime and record["size"] == stat.st_size:
+                return record, None
+            digest = file_hash(file_path)
+            if record["hash"] == digest:
+                self.put(file_path,record["text"],record["tokens"],digest)
+                return record, digest
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"缓存文件 {self.path(file_path)} 无效，重新抽取:{e}")
+            return None, None
+        return None, digest
+    def put(self,file_path,text,tokens,digest=None):
+        stat = os.stat(file_path)
+        record = {"mtime":stat.st_mtime,"size":stat.st_size,"hash":digest or file_hash(file_path),
+                  "tokenizer":self.tokenizer,"text":text,"tokens":tokens}
+        with open(self.path(file_path) + ".tmp","w",encoding="utf-8") as f:
+            json.dump(record,f,ensure_ascii=False)
+        os.replace(self.path(file_path) + ".tmp",self.path(file_path))
 
 class SimpleRAG:
-    def __init__(self,folder_path='/Library/workerspace/python_test/badou2/week14/pdf'):
+    def __init__(self,folder_path='/Library/workerspace/python_test/badou2/week14/pdf',backend=None,
+                 cache_dir=".pdf_cache",workers=None):
+        self.backend = backend or default_backend
+        self.pdf_cache = PdfCache(cache_dir)
+        self.workers = workers
         self.load_data(folder_path)
 
     def load_data(self,path):
+        start_time = time.time()
         self.hero_data = {}
-        for file_name in os.listdir(path):
+        hero_tokens = {}
+        #先从缓存中取，没有缓存或文件有变化的放进进程池并行抽取
+        to_extract = {}
+        for file_name in sorted(os.listdir(path)):
             if file_name.endswith(".pdf"):
                 file_path = os.path.join(path,file_name)
-                try:
-                    with open(file_path,"rb" ) as f:
-                        pdf_reader = PyPDF2.PdfReader(f)
-                        intro =""
-                        for page in pdf_reader.pages:
-                            intro += page.extract_text()
-                        hero = file_name.split(".")[0]
-                        self.hero_data[hero] = intro
-                except Exception as e:
-                    print(f"读取pdf文件 {file_name} 异常:{e}")
-                    continue
+                hero = file_name.split(".")[0]
+                record, digest = self.pdf_cache.get(file_path)
+                if record is not None:
+                    self.hero_data[hero] = record["text"]
+                    hero_tokens[hero] = record["tokens"]
+                else:
+                    to_extract[hero] = (file_name, file_path, digest)
+        if to_extract:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                futures = dict((hero, executor.submit(extract_pdf, file_path))
+                               for hero, (_, file_path, _) in to_extract.items())
+                for hero, future in futures.items():
+                    file_name, file_path, digest = to_extract[hero]
+                    try:
+                        intro, tokens = future.result()
+                    except Exception as e:
+                        print(f"读取pdf文件 {file_name} 异常:{e}")
+                        continue
+                    self.pdf_cache.put(file_path,intro,tokens,digest)
+                    self.hero_data[hero] = intro
+                    hero_tokens[hero] = tokens
         corpus = {}
         self.index_to_name ={}
         index = 0
-        for hero,intro in self.hero_data.items():
-            corpus[hero] = jieba.lcut(intro)
+        for hero in self.hero_data:
+            corpus[hero] = hero_tokens[hero]
             self.index_to_name[index] = hero
             index +=1
         self.bm25_model = BM25(corpus)
+        print(f"加载{len(self.hero_data)}个pdf，其中新抽取{len(to_extract)}个，耗时{time.time() - start_time:.2f}秒")
         return
     def retrieve(self,user_query):
-        scores = self.bm25_model.get_scores(jieba.lcut(user_query))
-        sorted_scores = sorted(scores,key=lambda x:x[1],reverse = True)
-        hero = sorted_scores[0][0]
+        #倒排索引只累加命中的文档，取得分最高的一个
+        hero = self.bm25_model.get_top_k(jieba.lcut(user_query), 1)[0][0]
         text = self.hero_data[hero]
         return text
+    def build_prompt(self,user_query):
+        retrieve_text = self.retrieve(user_query)
+        return f"请根据以下从数据库中获得的英雄故事和技能介绍，回答用户问题：\n\n英雄故事及技能介绍：\n{retrieve_text}\n\n用户问题：{user_query}"
     def query(self,user_query):
         print("user_query", user_query)
         print("-------------------------------")
-        retrieve_text = self.retrieve(user_query)
+        prompt = self.build_prompt(user_query)
         print("-------------------------------")
-        prompt = f"请根据以下从数据库中获得的英雄故事和技能介绍，回答用户问题：\n\n英雄故事及技能介绍：\n{retrieve_text}\n\n用户问题：{user_query}"
-        response_text = call_large_model(prompt)
+        response_text = call_large_model(prompt, self.backend)
         print("模型回答:", response_text)
         print("-------------------------------")
+        return response_text
+    #一批问题先依次检索，再把所有prompt并发发给大模型
+    def query_batch(self,user_queries):
+        prompts = [self.build_prompt(user_query) for user_query in user_queries]
+        return self.backend.generate_batch(prompts)
+    #统计检索和生成两部分的吞吐，第二轮的prompt相同，全部命中缓存
+    def benchmark(self,user_queries):
+        start_time = time.time()
+        prompts = [self.build_prompt(user_query) for user_query in user_queries]
+        retrieve_time = time.time() - start_time
+        for round_name in ["首次", "缓存"]:
+            start_time = time.time()
+            self.backend.generate_batch(prompts)
+            generate_time = time.time() - start_time
+            print(f"{round_name}：{len(user_queries)}个问题，检索{retrieve_time:.3f}秒，生成{generate_time:.3f}秒，"
+                  f"每秒{len(user_queries) / (retrieve_time + generate_time):.2f}个问题")
 if __name__ =="__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "fake":
+        #不联网，用替身后端跑通检索+生成并测试并发吞吐
+        rag = SimpleRAG(backend=FakeBackend(latency=0.5, max_concurrency=8, requests_per_second=20))
+        rag.benchmark(["黑神话：悟空火爆的基础是什么?", "黑神话：悟空的销量如何?", "黑神话：悟空是哪家公司开发的?"] * 10)
+        sys.exit(0)
     rag = SimpleRAG()
     user_query ="黑神话：悟空火爆的基础是什么?"
     rag.query(user_query)
@@ -49,9 +49,8 @@ class SimpleRAG:
         return
 
     def retrieve(self,user_query):
-        scores = self.bm25_model.get_scores(jieba.lcut(user_query))
-        sorted_scores = sorted(scores,key = lambda x :x[1], reverse = True)
-        hero = sorted_scores[0][0]
+        #倒排索引只累加命中的文档，取得分最高的一个
+        hero = self.bm25_model.get_top_k(jieba.lcut(user_query), 1)[0][0]
         text = self.hero_data[hero]
         return text
 
@@ -0,0 +1,164 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class RateLimiter:
+    """令牌桶限流：平均每秒最多rate个请求，允许burst个请求的突发"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_time = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate)
+                self.last_time = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class LLMBackend:
+    """
+    大模型调用的统一接口，子类实现 _complete(同步) 和 _acomplete(异步)
+    - 按 模型名+prompt 的hash缓存回答，cache_path不为None时追加写入jsonl文件，下次运行继续使用
+    - generate_batch 并发发送一批prompt，max_concurrency限制同时进行的请求数，requests_per_second限制请求速率
+    """
+    model = ""
+
+    def __init__(self, max_concurrency=4, requests_per_second=None, cache_path=None):
+        self.max_concurrency = max_concurrency
+        self.requests_per_second = requests_per_second
+        self.cache_path = cache_path
+        self.cache = {}
+        self.cache_lock = threading.Lock()
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path, encoding="utf-8") as f:
+                for line in f:
+                    record = json.loads(line)
+                    self.cache[record["key"]] = record["response"]
+
+    def cache_key(self, prompt):
+        return hashlib.sha256((self.model + "\0" + prompt).encode("utf-8")).hexdigest()
+
+    def save_response(self, key, response):
+        with self.cache_lock:
+            self.cache[key] = response
+            if self.cache_path is not None:
+                with open(self.cache_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"key": key, "response": response}, ensure_ascii=False) + "\n")
+
+    def _complete(self, prompt):
+        raise NotImplementedError
+
+    async def _acomplete(self, prompt):
+        raise NotImplementedError
+
+    def generate(self, prompt):
+        key = self.cache_key(prompt)
+        if key not in self.cache:
+            self.save_response(key, self._complete(prompt))
+        return self.cache[key]
+
+    async def agenerate_batch(self, prompts):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        limiter = RateLimiter(self.requests_per_second) if self.requests_per_second else None
+
+        async def generate_one(key, prompt):
+            async with semaphore:
+                if limiter is not None:
+                    await limiter.acquire()
+                self.save_response(key, await self._acomplete(prompt))
+
+        # 相同的prompt只请求一次
+        pending = {}
+        for prompt in prompts:
+            key = self.cache_key(prompt)
+            if key not in self.cache and key not in pending:
+                pending[key] = prompt
+        await asyncio.gather(*[generate_one(key, prompt) for key, prompt in pending.items()])
+        return [self.cache[self.cache_key(prompt)] for prompt in prompts]
+
+    def generate_batch(self, prompts):
+        return asyncio.run(self.agenerate_batch(prompts))
+
+
+class OpenAIBackend(LLMBackend):
+    """
+    OpenAI兼容接口(如百炼)，客户端只创建一次，复用其中的HTTP连接池
+    同步和异步各一个客户端，第一次使用时创建
+    """
+
+    def __init__(self, api_key, base_url="https://dashscope.aliyuncs.com/compatible-mode/v1", model="qwen-plus",
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.api_key = api_key
+        self.base_url = base_url
+        self.model = model
+        self.client = None
+        self.async_client = None
+
+    def _complete(self, prompt):
+        if self.client is None:
+            from openai import OpenAI
+            self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
+        completion = self.client.chat.completions.create(
+            model=self.model,
+            messages=[{"role": "user", "content": prompt}],
+        )
+        return completion.choices[0].message.content
+
+    async def _acomplete(self, prompt):
+        if self.async_client is None:
+            from openai import AsyncOpenAI
+            self.async_client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url)
+        completion = await self.async_client.chat.completions.create(
+            model=self.model,
+            messages=[{"role": "user", "content": prompt}],
+        )
+        return completion.choices[0].message.content
+
+    async def agenerate_batch(self, prompts):
+        # AsyncOpenAI的连接绑定在创建它的事件循环上，每次asyncio.run结束后重新创建
+        try:
+            return await super().agenerate_batch(prompts)
+        finally:
+            if self.async_client is not None:
+                await self.async_client.close()
+                self.async_client = None
+
+
+class FakeBackend(LLMBackend):
+    """
+    离线替身：不联网，根据prompt确定性地生成回答(用户问题 + 资料开头)
+    latency模拟每次请求的耗时，用于在没有网络时测试整个RAG流程和并发吞吐
+    """
+    model = "fake"
+
+    def __init__(self, latency=0.5, answer_length=50, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.answer_length = answer_length
+
+    def make_answer(self, prompt):
+        question = prompt.rsplit("用户问题：", 1)[-1].strip()
+        context = prompt.split("\n\n", 1)[-1]
+        return "[fake] 关于“%s”，资料显示：%s" % (question, context[:self.answer_length].replace("\n", " "))
+
+    def _complete(self, prompt):
+        time.sleep(self.latency)
+        return self.make_answer(prompt)
+
+    async def _acomplete(self, prompt):
+        await asyncio.sleep(self.latency)
+        return self.make_answer(prompt)